@@ -0,0 +1,89 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Benchmark the venv lookup in a big cache index.
+
+The lookups are done for requirements that are not served by any venv, so
+the whole index is always walked (the worst case).
+
+The first lookup (that needs to read the index and build its entries) is
+measured separately from the later ones (that reuse them), and also
+compared between reading and decoding all the lines, and scanning the
+memory mapped index for the lines that mention the required projects, in
+an index where the venvs have different projects installed.
+"""
+
+import os
+import tempfile
+
+from packaging.requirements import Requirement
+
+from benchmarks.generators import make_index
+from benchmarks.timer import average
+
+from fades import cache
+
+ENTRIES = 10000
+PACKAGES = 5
+PROJECTS = 200
+RUNS = 10
+
+
+def _bench_lookups(filepath, results):
+    """Time the lookups when all the venvs have the required projects."""
+    make_index(filepath, ENTRIES, PACKAGES)
+    reqs = {'pypi': [Requirement('dep{} > {}'.format(j, ENTRIES)) for j in range(PACKAGES)]}
+    lines = cache.VEnvsCache(filepath)._read_lines()
+    venvscache = None
+
+    def new_cache():
+        nonlocal venvscache
+        venvscache = cache.VEnvsCache(filepath)
+
+    prefix = "cache.{}_entries.".format(ENTRIES)
+    results[prefix + "get_venv.first"] = average(
+        lambda: venvscache.get_venv(reqs), RUNS, setup=new_cache)
+    results[prefix + "get_venv.later"] = average(lambda: venvscache.get_venv(reqs), RUNS)
+    results[prefix + "select.later"] = average(lambda: venvscache._select(lines, reqs), RUNS)
+
+
+def _bench_loading(filepath, results):
+    """Time the first lookup reading all the index against scanning it for candidates."""
+    make_index(filepath, ENTRIES, PACKAGES, projects=PROJECTS)
+    reqs = {'pypi': [Requirement('dep{} > {}'.format(j, ENTRIES)) for j in range(2)]}
+    venvscache = None
+
+    def new_cache():
+        nonlocal venvscache
+        venvscache = cache.VEnvsCache(filepath)
+
+    prefix = "cache.{}_entries_{}_projects.".format(ENTRIES, PROJECTS)
+    results[prefix + "first_read_all"] = average(
+        lambda: venvscache._select(venvscache._read_lines(), reqs), RUNS, setup=new_cache)
+    results[prefix + "first_scan_mmap"] = average(
+        lambda: venvscache.get_venv(reqs), RUNS, setup=new_cache)
+
+
+def run():
+    """Time the lookups."""
+    results = {}
+    _, filepath = tempfile.mkstemp(prefix="fades-bench")
+    try:
+        _bench_lookups(filepath, results)
+        _bench_loading(filepath, results)
+    finally:
+        os.remove(filepath)
+    return results
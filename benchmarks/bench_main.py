@@ -0,0 +1,105 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Benchmark running scripts through 'bin/fades', end to end.
+
+Everything happens in a temporary home (so the real fades base directory is
+not touched), and the dependencies are installed from local wheels built
+for the benchmark (so nothing is downloaded):
+
+- cold: nothing exists, not even the template venv
+- new venv: the template exists, but not a venv for the script
+- warm: the venv for the script exists (with and without the daemon)
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generators import make_wheel
+from benchmarks.timer import average
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FADES = os.path.join(PROJECT_DIR, 'bin', 'fades')
+
+COLD_RUNS = 1
+NEW_VENV_RUNS = 3
+WARM_RUNS = 20
+
+
+def _get_env(homedir, wheels_dir):
+    """Return the environment to run fades in that home, with pip using the local wheels."""
+    return dict(os.environ, HOME=homedir, XDG_DATA_HOME=os.path.join(homedir, 'data'),
+                PIP_NO_INDEX='1', PIP_FIND_LINKS=wheels_dir,
+                PIP_DISABLE_PIP_VERSION_CHECK='1')
+
+
+def _run(cmd, env):
+    """Run the command, quietly."""
+    subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run():
+    """Time the scripts run through fades."""
+    results = {}
+    tempdir = tempfile.mkdtemp(prefix="fades-bench")
+    try:
+        wheels_dir = os.path.join(tempdir, 'wheels')
+        os.mkdir(wheels_dir)
+        for i in range(NEW_VENV_RUNS + 1):
+            make_wheel(wheels_dir, 'benchdep{}'.format(i), '1.0')
+        scripts = []
+        for i in range(NEW_VENV_RUNS + 1):
+            script = os.path.join(tempdir, 'script{}.py'.format(i))
+            with open(script, 'wt', encoding='utf8') as fh:
+                fh.write("import benchdep{}    # fades.pypi\n".format(i))
+            scripts.append(script)
+
+        # cold, every time in a new home
+        homes = iter(range(COLD_RUNS))
+
+        def cold():
+            homedir = os.path.join(tempdir, 'cold{}'.format(next(homes)))
+            _run([sys.executable, FADES, '-q', scripts[0]], _get_env(homedir, wheels_dir))
+        results["main.cold"] = average(cold, COLD_RUNS)
+
+        # all the rest in the same home, the first script's venv already exists
+        env = _get_env(os.path.join(tempdir, 'cold0'), wheels_dir)
+        new_scripts = iter(scripts[1:])
+        results["main.new_venv"] = average(
+            lambda: _run([sys.executable, FADES, '-q', next(new_scripts)], env), NEW_VENV_RUNS)
+
+        results["main.warm.bare_python"] = average(
+            lambda: _run([sys.executable, '-c', 'pass'], env), WARM_RUNS)
+        results["main.warm"] = average(
+            lambda: _run([sys.executable, FADES, '-q', scripts[0]], env), WARM_RUNS)
+
+        daemon = subprocess.Popen([sys.executable, FADES, '-q', '--daemon'], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # let it start
+            time.sleep(1)
+            results["main.warm.daemon"] = average(
+                lambda: _run([sys.executable, FADES, '-q', scripts[0]], env), WARM_RUNS)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    finally:
+        shutil.rmtree(tempdir)
+    return results
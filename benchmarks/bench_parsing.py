@@ -0,0 +1,60 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Benchmark the parsing of scripts, for different amount of imports and code.
+
+The parsing of all the content line by line, of the whole file (that only
+decodes and parses the lines marked as dependencies), and of only the
+file's header.
+"""
+
+import os
+import shutil
+import tempfile
+
+from benchmarks.generators import make_script
+from benchmarks.timer import average
+
+from fades import parsing
+
+# (marked imports, filler lines of code)
+CASES = [(10, 0), (100, 0), (10, 10000), (10, 100000)]
+RUNS = 10
+
+
+def run():
+    """Time the parsing of the scripts' content."""
+    results = {}
+    tempdir = tempfile.mkdtemp(prefix="fades-bench")
+    try:
+        for imports, filler in CASES:
+            filepath = os.path.join(tempdir, 'script.py')
+            make_script(filepath, imports, filler)
+
+            def parse():
+                with open(filepath, 'rt', encoding='utf8') as fh:
+                    parsing._parse_content(fh)
+
+            name = "parsing.content.{}_imports.{}_lines".format(imports, filler)
+            results[name] = average(parse, RUNS)
+            name = "parsing.file.{}_imports.{}_lines".format(imports, filler)
+            results[name] = average(lambda: parsing.parse_file(filepath), RUNS)
+            name = "parsing.header.{}_imports.{}_lines".format(imports, filler)
+            results[name] = average(
+                lambda: parsing.parse_file(filepath, header_only=True), RUNS)
+    finally:
+        shutil.rmtree(tempdir)
+    return results
@@ -0,0 +1,103 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Generators of the synthetic data used by the benchmarks."""
+
+import base64
+import hashlib
+import json
+import os
+import zipfile
+
+
+def make_script(filepath, imports, filler=0, project="dep"):
+    """Write a script with that many marked imports, followed by filler lines of code.
+
+    Half of the imports are marked in the same line, and the other half in the
+    line before, with a version every other one.
+    """
+    lines = ['"""A synthetic script."""', '']
+    for i in range(imports):
+        mark = "# fades.pypi" + (" >= {}".format(i) if i % 2 else "")
+        module = "{}{}".format(project, i)
+        if i % 4 < 2:
+            lines.append("import {}    {}".format(module, mark))
+        else:
+            lines.append(mark)
+            lines.append("from {} import something".format(module))
+    lines.append('')
+    for i in range(filler):
+        # some of the filler mentions fades, to not discard it too easily
+        if i % 1000:
+            lines.append("value_{0} = compute({0})  # just a comment".format(i))
+        else:
+            lines.append("print('fades is great', {})".format(i))
+    with open(filepath, 'wt', encoding='utf8') as fh:
+        fh.write('\n'.join(lines) + '\n')
+
+
+def make_index(filepath, entries, packages, projects=None):
+    """Write a venvs index with that many entries of that many packages each.
+
+    The packages are taken from a pool of projects (by default, just the
+    needed to have the same ones in all the venvs).
+    """
+    if projects is None:
+        projects = packages
+    with open(filepath, 'wt', encoding='utf8') as fh:
+        for i in range(entries):
+            installed = {'dep{}'.format((i + j) % projects): '{}.{}'.format(i, j)
+                         for j in range(packages)}
+            fh.write(json.dumps({
+                'timestamp': i,
+                'installed': {'pypi': installed},
+                'metadata': {'env_path': 'venv{}'.format(i),
+                             'env_bin_path': 'venv{}/bin'.format(i)},
+            }) + '\n')
+
+
+def _record_hash(content):
+    """Return the hash of the content as used in the wheel's RECORD."""
+    digest = base64.urlsafe_b64encode(hashlib.sha256(content).digest()).rstrip(b'=')
+    return "sha256=" + digest.decode('ascii')
+
+
+def make_wheel(dirpath, name, version):
+    """Build a minimal pure Python wheel (with just a module) in the directory.
+
+    Return the wheel's path.
+    """
+    dist_info = "{}-{}.dist-info".format(name, version)
+    files = {
+        name + ".py": "VERSION = {!r}\n".format(version),
+        dist_info + "/METADATA": (
+            "Metadata-Version: 2.1\nName: {}\nVersion: {}\n".format(name, version)),
+        dist_info + "/WHEEL": (
+            "Wheel-Version: 1.0\nGenerator: fades-benchmarks\n"
+            "Root-Is-Purelib: true\nTag: py3-none-any\n"),
+    }
+    record = []
+    for path, content in files.items():
+        content = content.encode('utf8')
+        record.append("{},{},{}".format(path, _record_hash(content), len(content)))
+    record.append(dist_info + "/RECORD,,")
+
+    wheel_path = os.path.join(dirpath, "{}-{}-py3-none-any.whl".format(name, version))
+    with zipfile.ZipFile(wheel_path, 'w') as zf:
+        for path, content in files.items():
+            zf.writestr(path, content)
+        zf.writestr(dist_info + "/RECORD", '\n'.join(record) + '\n')
+    return wheel_path
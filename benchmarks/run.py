@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Run the benchmarks, saving the results to compare them across commits.
+
+    benchmarks/run.py [--output=FILE] [--compare=FILE] [parsing] [cache] [main]
+
+By default all the benchmarks are run; the results (average time of each
+measure, in seconds) are saved as JSON together with the commit and the
+Python used, and if other results file is given they are compared.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from benchmarks import bench_cache, bench_main, bench_parsing  # NOQA
+
+BENCHMARKS = {
+    'parsing': bench_parsing,
+    'cache': bench_cache,
+    'main': bench_main,
+}
+
+
+def get_commit():
+    """Return the commit being benchmarked, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results):
+    """Show the results compared to the previous ones."""
+    print("Compared to commit {} ({}):".format(previous['commit'], previous['date']))
+    for name, value in sorted(results.items()):
+        if name in previous['results']:
+            old_value = previous['results'][name]
+            print("    {:50} {:10.2f} ms {:10.2f} ms  x{:.2f}".format(
+                name, old_value * 1000, value * 1000, value / old_value))
+
+
+def main():
+    """Run the indicated benchmarks."""
+    parser = argparse.ArgumentParser(description="Run the fades benchmarks.")
+    parser.add_argument('benchmarks', nargs='*',
+                        help="what to run, from {} (by default, all)".format(
+                            ", ".join(sorted(BENCHMARKS))))
+    parser.add_argument('--output', help="file where to save the results")
+    parser.add_argument('--compare', help="file with previous results to compare")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    results = {}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print("Running {} benchmarks...".format(name))
+        results.update(BENCHMARKS[name].run())
+    for name, value in sorted(results.items()):
+        print("    {:50} {:10.2f} ms".format(name, value * 1000))
+
+    data = {
+        'commit': get_commit(),
+        'python': sys.version,
+        'date': datetime.datetime.now().isoformat(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'wt', encoding='utf8') as fh:
+            json.dump(data, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'rt', encoding='utf8') as fh:
+            compare(json.load(fh), results)
+
+
+if __name__ == '__main__':
+    main()
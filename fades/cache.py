@@ -17,81 +17,666 @@
 
 """The cache manager for virtualenvs."""
 
+import hashlib
 import json
 import logging
+import contextlib
+import mmap
 import os
+import re
+import shutil
+import sqlite3
 import time
 
-from pkg_resources import Distribution
+try:
+    from packaging.utils import canonicalize_name
+    from packaging.version import Version, InvalidVersion
+except ImportError:
+    # way slower to import, but always there with setuptools
+    from pkg_resources.extern.packaging.utils import canonicalize_name
+    from pkg_resources.extern.packaging.version import Version, InvalidVersion
+
+from fades.helpers import atomic_write, locked, remove_lock
 
 logger = logging.getLogger(__name__)
 
 
+def get_fingerprint(requirements):
+    """Return a canonical fingerprint for the requirements.
+
+    The same set of requirements (no matter the order in which they were
+    marked in the script, or the case of the project names) always gives
+    the same fingerprint.
+    """
+    canonical = []
+    for repo in sorted(requirements):
+        deps = []
+        for req in requirements[repo]:
+            specs = ",".join(sorted(str(spec) for spec in req.specifier))
+            extras = ",".join(sorted(req.extras))
+            deps.append("{}[{}]{}".format(canonicalize_name(req.name), extras, specs))
+        canonical.append([repo, sorted(deps)])
+    serialized = json.dumps(canonical, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf8')).hexdigest()
+
+
+def _decode_venv(venv_str):
+    """Decode an index line, raise ValueError if it's not a venv with the needed info."""
+    try:
+        venv = json.loads(venv_str)
+        metadata = venv['metadata']
+        if not isinstance(metadata, dict) or not isinstance(venv['installed'], dict):
+            raise ValueError("metadata and installed must be dicts")
+        if 'env_path' not in metadata or 'env_bin_path' not in metadata:
+            raise ValueError("the venv paths are missing")
+    except (KeyError, TypeError) as error:
+        raise ValueError("not a venv: {!r}".format(error))
+    return venv
+
+
+def _get_size(path, seen=()):
+    """Return the size of the files in the directory, and their inodes.
+
+    As the venvs share a lot of files (hardlinked), each file is counted
+    once, and not at all if its inode was already seen.
+    """
+    total = 0
+    inodes = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, fname))
+            except OSError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            if inode in seen or inode in inodes:
+                continue
+            inodes.add(inode)
+            total += stat.st_size
+    return total, inodes
+
+
+class InstalledPackage:
+    """A package installed in a venv, with its version already parsed."""
+
+    __slots__ = ('key', 'version')
+
+    def __init__(self, project, version):
+        self.key = canonicalize_name(project)
+        try:
+            self.version = Version(version)
+        except InvalidVersion:
+            # not a version that can be compared, only useful for requirements with no specs
+            self.version = None
+
+    def satisfies(self, requirement):
+        """Tell if this package satisfies the requirement (which is for the same project)."""
+        if self.version is None:
+            return not requirement.specifier
+        return requirement.specifier.contains(self.version, prereleases=True)
+
+
 class VEnvsCache:
-    """A cache for virtualenvs."""
+    """A cache for virtualenvs.
+
+    Besides the main index (where each line is a venv with what it has
+    installed), there is a secondary one, keyed by the fingerprint of the
+    requirements that originated each venv, so exact matches are found
+    without walking the whole main index.
+    """
 
     def __init__(self, filepath):
         logger.debug("Using cache index: %r", filepath)
         self.filepath = filepath
+        self.fprpath = filepath + '.fpr'
+        self.lockspath = filepath + '.locks'
+        self._entries = {}
+        self._index_id = None
+
+    @contextlib.contextmanager
+    def lock(self, requirements):
+        """Lock these requirements, to get (or create) their venv without other process.
+
+        So if several processes need the same venv at the same time only one of them
+        creates it, and the others wait and then reuse it.
+        """
+        with locked(os.path.join(self.lockspath, get_fingerprint(requirements))):
+            yield
+
+    def mark_used(self, metadata):
+        """Record that the venv was used now (in its directory's modification time)."""
+        try:
+            os.utime(metadata['env_path'])
+        except OSError as error:
+            logger.warning("Couldn't mark the venv as used: %s", error)
+
+    def collect(self, max_age=None, max_count=None, max_size=None):
+        """Evict the least recently used venvs, until all the limits are satisfied.
+
+        The limits are the age of the venvs (since they were last used, in seconds),
+        how many venvs are kept, and the total size of them (in bytes). The venvs
+        whose directory doesn't exist anymore are always removed from the index.
+
+        Return the paths of the evicted venvs.
+        """
+        venvs = []
+        for _, venv in self._iter_entries():
+            env_path = venv['metadata']['env_path']
+            try:
+                last_use = os.stat(env_path).st_mtime
+            except FileNotFoundError:
+                last_use = None
+            venvs.append((env_path, last_use))
+
+        # most recently used first, the ones already gone at the end
+        venvs.sort(key=lambda item: -1 if item[1] is None else item[1], reverse=True)
+        now = time.time()
+        evicted = set()
+        kept = 0
+        total_size = 0
+        kept_inodes = set()
+        for env_path, last_use in venvs:
+            if last_use is None:
+                logger.debug("Venv directory not found, removing it from index: %r", env_path)
+                evicted.add(env_path)
+                continue
+            if max_age is not None and now - last_use > max_age:
+                evicted.add(env_path)
+                continue
+            if max_count is not None and kept >= max_count:
+                evicted.add(env_path)
+                continue
+            if max_size is not None:
+                # only what is not shared with the venvs already kept
+                size, inodes = _get_size(env_path, kept_inodes)
+                if total_size + size > max_size:
+                    evicted.add(env_path)
+                    continue
+                total_size += size
+                kept_inodes.update(inodes)
+            kept += 1
+
+        for env_path in evicted:
+            logger.info("Removing venv %r", env_path)
+            shutil.rmtree(env_path, ignore_errors=True)
+        if evicted:
+            self._remove(evicted)
+        self._collect_shared()
+        return evicted
+
+    def _collect_shared(self):
+        """Remove what was shared by the venvs and is not used anymore.
+
+        That is the packages in the store and the templates no venv has files
+        from, and the locks of the requirements not held by anybody.
+        """
+        from fades import envbuilder, pkgstore  # only here, so the cache is fast to import
+        basedir = os.path.dirname(self.filepath)
+        pkgstore.prune(basedir)
+        envbuilder.prune_templates(basedir)
+
+        try:
+            fnames = os.listdir(self.lockspath)
+        except FileNotFoundError:
+            return
+        for fname in fnames:
+            if fname != 'index':
+                remove_lock(os.path.join(self.lockspath, fname))
+
+    def is_alive(self, metadata):
+        """Tell if the venv is still there, with its interpreter."""
+        return (os.path.isdir(metadata['env_path']) and
+                os.path.exists(os.path.join(metadata['env_bin_path'], 'python3')))
+
+    def compact(self):
+        """Rewrite the index with only the venvs that are alive, once each.
+
+        Broken lines are dropped, as the entries of venvs whose directory or
+        interpreter doesn't exist anymore, and repeated entries for the same venv.
+        """
+        with locked(os.path.join(self.lockspath, 'index')):
+            lines = self._read_lines()
+            seen = set()
+            to_keep = []
+            for venv_str in lines:
+                entry = self._load_entry(venv_str)
+                if entry is None:
+                    continue
+                metadata = entry[1]['metadata']
+                if metadata['env_path'] in seen:
+                    logger.debug("Dropping repeated venv from index: %s", metadata)
+                    continue
+                if not self.is_alive(metadata):
+                    logger.debug("Dropping dead venv from index: %s", metadata)
+                    continue
+                seen.add(metadata['env_path'])
+                to_keep.append(venv_str)
+            atomic_write(self.filepath, "".join(line + '\n' for line in to_keep))
+        logger.debug("Index compacted from %d to %d venvs", len(lines), len(to_keep))
+
+        # the fingerprint index only keeps what is alive in the main index
+        if os.path.exists(self.fprpath):
+            for fname in os.listdir(self.fprpath):
+                fpr_file = os.path.join(self.fprpath, fname)
+                try:
+                    with open(fpr_file, 'rt', encoding='utf8') as fh:
+                        env_path = json.load(fh)['metadata']['env_path']
+                except (OSError, ValueError, KeyError, TypeError):
+                    env_path = None
+                if env_path not in seen:
+                    os.remove(fpr_file)
+
+    def _remove(self, env_paths):
+        """Remove the venvs from the index (and the fingerprint index)."""
+        def keep(venv_str):
+            try:
+                return json.loads(venv_str)['metadata']['env_path'] not in env_paths
+            except (ValueError, KeyError, TypeError):
+                return True
+
+        with locked(os.path.join(self.lockspath, 'index')):
+            lines = [line for line in self._read_lines() if keep(line)]
+            atomic_write(self.filepath, "".join(line + '\n' for line in lines))
+
+        if os.path.exists(self.fprpath):
+            for fname in os.listdir(self.fprpath):
+                fpr_file = os.path.join(self.fprpath, fname)
+                try:
+                    with open(fpr_file, 'rt', encoding='utf8') as fh:
+                        to_keep = keep(fh.read())
+                except OSError:
+                    continue
+                if not to_keep:
+                    os.remove(fpr_file)
 
     def _venv_match(self, installed, requirements):
         """Return True if what is installed satisfies the requirements.
 
+        The installed packages are already built, keyed by project (see
+        `_build_installed`), so each requirement is checked directly against
+        the only package that can satisfy it.
+
         This method has multiple exit-points, but only for False (because
         if *anything* is not satisified, the venv is no good). Only after
         all was checked, and it didn't exit, the venv is ok so return True.
         """
-        useful_inst = set()
         for repo, req_deps in requirements.items():
             if repo not in installed:
                 # the venv doesn't even have the repo
                 return False
 
-            inst_deps = {Distribution(project_name=dep, version=ver)
-                         for (dep, ver) in installed[repo].items()}
+            inst_deps = installed[repo]
+            useful_inst = set()
             for req in req_deps:
-                for inst in inst_deps:
-                    if inst in req:
-                        useful_inst.add(inst)
-                        break
-                else:
+                key = canonicalize_name(req.name)
+                inst = inst_deps.get(key)
+                if inst is None or not inst.satisfies(req):
                     # nothing installed satisfied that requirement
                     return False
+                useful_inst.add(key)
 
             # assure *all* that is installed is useful for the requirements
-            if useful_inst != inst_deps:
+            if len(useful_inst) != len(inst_deps):
                 return False
 
         # it did it through!
         return True
 
+    def _venv_missing(self, installed, requirements):
+        """Return what the venv is missing to satisfy the requirements.
+
+        It's None if the venv can not be used as a base for them, because it has
+        something installed that is not useful or that doesn't satisfy them.
+        """
+        missing = {}
+        for repo, inst_deps in installed.items():
+            if inst_deps and repo not in requirements:
+                return
+        for repo, req_deps in requirements.items():
+            inst_deps = installed.get(repo, {})
+            useful_inst = set()
+            for req in req_deps:
+                key = canonicalize_name(req.name)
+                inst = inst_deps.get(key)
+                if inst is None:
+                    missing.setdefault(repo, []).append(req)
+                elif inst.satisfies(req):
+                    useful_inst.add(key)
+                else:
+                    return
+            if len(useful_inst) != len(inst_deps):
+                return
+        return missing
+
+    def get_venv_to_extend(self, requirements):
+        """Find the venv that satisfies most of the requirements, without extra stuff.
+
+        Return its metadata, what it has installed, and the requirements that it's
+        missing; or None if no venv is useful at all.
+        """
+        best = None
+        best_size = 0
+        for installed, venv in self._iter_entries():
+            missing = self._venv_missing(installed, requirements)
+            if missing is None:
+                continue
+            size = sum(len(deps) for deps in installed.values())
+            if size > best_size:
+                best = venv['metadata'], venv['installed'], missing
+                best_size = size
+        if best is None:
+            logger.debug("No venv found to extend")
+        else:
+            logger.debug("Found a venv to extend! %s (missing %s)", best[0], best[2])
+        return best
+
+    def _build_installed(self, installed):
+        """Build the installed packages, keyed by repo and then by project."""
+        return {repo: {pkg.key: pkg for pkg in (InstalledPackage(project, version)
+                                                for project, version in deps.items())}
+                for repo, deps in installed.items()}
+
+    def _load_entry(self, venv_str):
+        """Decode an index line, building its installed packages only once per process.
+
+        Return None if the line is broken.
+        """
+        try:
+            return self._entries[venv_str]
+        except KeyError:
+            pass
+        try:
+            venv = _decode_venv(venv_str)
+            entry = (self._build_installed(venv['installed']), venv)
+        except (ValueError, AttributeError):
+            logger.warning("Ignoring broken line in the index: %r", venv_str)
+            entry = None
+        self._entries[venv_str] = entry
+        return entry
+
     def _select(self, current_venvs, requirements):
         """Select which venv satisfy the received requirements."""
         logger.debug("Searching a venv for reqs: %s", requirements)
         for venv_str in current_venvs:
-            venv = json.loads(venv_str)
-            if self._venv_match(venv['installed'], requirements):
+            entry = self._load_entry(venv_str)
+            if entry is None:
+                continue
+            installed, venv = entry
+            if self._venv_match(installed, requirements):
                 logger.debug("Found a matching venv! %s", venv)
                 return venv['metadata']
         logger.debug("No matching venv found :(")
 
-    def get_venv(self, requirements):
-        """Find a venv that serves these requirements, if any."""
-        if os.path.exists(self.filepath):
-            with open(self.filepath, 'rt', encoding='utf8') as fh:
-                lines = [x.strip() for x in fh]
+    def _get_by_fingerprint(self, requirements):
+        """Return the venv stored for exactly these requirements, if any."""
+        fpr_file = os.path.join(self.fprpath, get_fingerprint(requirements))
+        try:
+            with open(fpr_file, 'rt', encoding='utf8') as fh:
+                venv = _decode_venv(fh.read())
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning("Ignoring broken fingerprint index entry %r", fpr_file)
+            return
+        logger.debug("Found a venv by fingerprint! %s", venv)
+        return venv['metadata']
+
+    def _check_replaced(self, fh):
+        """Forget the entries already built if the index file was replaced.
+
+        The index is only appended to, or replaced when venvs are removed from it;
+        so in a long lived process the entries of the removed venvs don't pile up.
+        """
+        if fh is None:
+            index_id = None
         else:
+            stat = os.fstat(fh.fileno())
+            index_id = (stat.st_dev, stat.st_ino)
+        if index_id != self._index_id:
+            self._entries.clear()
+            self._index_id = index_id
+
+    def _read_lines(self):
+        """Return all the lines of the index."""
+        try:
+            fh = open(self.filepath, 'rt', encoding='utf8')
+        except FileNotFoundError:
             logger.debug("Index not found, starting empty")
-            lines = []
-        return self._select(lines, requirements)
+            self._check_replaced(None)
+            return []
+        with fh:
+            self._check_replaced(fh)
+            return [x.strip() for x in fh]
 
-    def store(self, installed_stuff, metadata):
-        """Store the virtualenv metadata for the indicated installed_stuff."""
+    def _iter_entries(self):
+        """Yield each venv in the index, with its installed packages already built."""
+        for venv_str in self._read_lines():
+            entry = self._load_entry(venv_str)
+            if entry is not None:
+                yield entry
+
+    def _read_candidates(self, requirements):
+        """Return the lines of the index that may have a venv for the requirements.
+
+        The index is memory mapped and only the lines that mention every required
+        project are decoded (a venv can not satisfy the requirements without having
+        all the projects installed).
+        """
+        patterns = []
+        for reqs in requirements.values():
+            for req in reqs:
+                parts = [re.escape(part.encode('ascii', 'replace'))
+                         for part in canonicalize_name(req.name).split('-')]
+                patterns.append(re.compile(b'"' + b'[-_.]+'.join(parts) + b'"', re.IGNORECASE))
+
+        try:
+            fh = open(self.filepath, 'rb')
+        except FileNotFoundError:
+            logger.debug("Index not found, starting empty")
+            self._check_replaced(None)
+            return []
+        with fh:
+            self._check_replaced(fh)
+            if os.fstat(fh.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return [line.decode('utf8').strip() for line in iter(mm.readline, b'')
+                        if all(pattern.search(line) for pattern in patterns)]
+
+    def get_venv(self, requirements):
+        """Find a venv that serves these requirements, if any."""
+        venv = self._get_by_fingerprint(requirements)
+        if venv is not None:
+            return venv
+        return self._select(self._read_candidates(requirements), requirements)
+
+    def store(self, installed_stuff, metadata, requirements=None):
+        """Store the virtualenv metadata for the indicated installed_stuff.
+
+        If the requirements that originated the venv are given, it's also
+        stored in the fingerprint index.
+        """
         new_content = {
             'timestamp': int(time.mktime(time.localtime())),
             'installed': installed_stuff,
             'metadata': metadata,
         }
         logger.debug("Storing installed=%s metadata=%s", installed_stuff, metadata)
-        with open(self.filepath, 'at', encoding='utf8') as fh:
-            fh.write(json.dumps(new_content) + '\n')
+
+        # the line is appended in only one write, holding the index lock
+        line = (json.dumps(new_content) + '\n').encode('utf8')
+        with locked(os.path.join(self.lockspath, 'index')):
+            fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        if requirements is not None:
+            os.makedirs(self.fprpath, exist_ok=True)
+            fpr_file = os.path.join(self.fprpath, get_fingerprint(requirements))
+            atomic_write(fpr_file, json.dumps(new_content))
+
+
+class SQLiteVEnvsCache(VEnvsCache):
+    """A cache for virtualenvs, indexed in a SQLite database.
+
+    The installed packages are in their own table, indexed by project, so
+    only the venvs that have everything that is required are really
+    checked. Also, as writes are transactional, several fades processes
+    can safely use the same database at the same time.
+    """
+
+    def __init__(self, filepath, migrate_from=None):
+        logger.debug("Using SQLite cache index: %r", filepath)
+        self.filepath = filepath
+        self.lockspath = filepath + '.locks'
+        dirpath = os.path.dirname(filepath)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        self.conn = sqlite3.connect(filepath, timeout=30)
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS venvs (
+                    id INTEGER PRIMARY KEY,
+                    timestamp INTEGER,
+                    fingerprint TEXT,
+                    metadata TEXT);
+                CREATE INDEX IF NOT EXISTS venvs_fingerprint ON venvs (fingerprint);
+                CREATE TABLE IF NOT EXISTS installed (
+                    venv_id INTEGER REFERENCES venvs (id),
+                    repo TEXT,
+                    project TEXT,
+                    key TEXT,
+                    version TEXT);
+                CREATE INDEX IF NOT EXISTS installed_key ON installed (key);
+                CREATE INDEX IF NOT EXISTS installed_venv ON installed (venv_id);
+                CREATE TABLE IF NOT EXISTS migrations (source TEXT PRIMARY KEY);
+            """)
+        if migrate_from is not None:
+            self._migrate(migrate_from)
+
+    def _migrate(self, idx_filepath):
+        """Import the venvs from a JSON lines index, only once."""
+        if not os.path.exists(idx_filepath):
+            return
+        source = os.path.abspath(idx_filepath)
+        with self.conn:
+            # hold the write lock from the check, so other fades starting at the same
+            # time wait and then find the migration done
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute("SELECT 1 FROM migrations WHERE source = ?", (source,))
+            if cursor.fetchone() is not None:
+                return
+
+            logger.debug("Migrating venvs from index %r", idx_filepath)
+            with open(idx_filepath, 'rt', encoding='utf8') as fh:
+                for line in fh:
+                    try:
+                        venv = _decode_venv(line)
+                    except ValueError:
+                        logger.warning("Ignoring broken line when migrating: %r", line)
+                        continue
+                    self._insert(venv.get('timestamp'), venv['installed'], venv['metadata'],
+                                 None)
+            self.conn.execute("INSERT INTO migrations VALUES (?)", (source,))
+
+    def _insert(self, timestamp, installed_stuff, metadata, fingerprint):
+        """Insert the venv and what it has installed (no commit here)."""
+        cursor = self.conn.execute(
+            "INSERT INTO venvs (timestamp, fingerprint, metadata) VALUES (?, ?, ?)",
+            (timestamp, fingerprint, json.dumps(metadata)))
+        venv_id = cursor.lastrowid
+        rows = [(venv_id, repo, project, canonicalize_name(project), version)
+                for repo, deps in installed_stuff.items()
+                for project, version in deps.items()]
+        self.conn.executemany("INSERT INTO installed VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _get_by_fingerprint(self, requirements):
+        """Return the venv stored for exactly these requirements, if any."""
+        cursor = self.conn.execute(
+            "SELECT metadata FROM venvs WHERE fingerprint = ? ORDER BY id LIMIT 1",
+            (get_fingerprint(requirements),))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        venv = json.loads(row[0])
+        logger.debug("Found a venv by fingerprint! %s", venv)
+        return venv
+
+    def _get_candidates(self, requirements):
+        """Return the ids of the venvs that have installed all the required projects."""
+        needed = {(repo, canonicalize_name(req.name))
+                  for repo, reqs in requirements.items() for req in reqs}
+        if not needed:
+            cursor = self.conn.execute("SELECT id FROM venvs ORDER BY id")
+        else:
+            condition = " OR ".join(["(repo = ? AND key = ?)"] * len(needed))
+            params = [item for pair in sorted(needed) for item in pair]
+            cursor = self.conn.execute(
+                "SELECT venv_id FROM installed WHERE " + condition +
+                " GROUP BY venv_id HAVING COUNT(DISTINCT repo || ' ' || key) = ?"
+                " ORDER BY venv_id", params + [len(needed)])
+        return [row[0] for row in cursor]
+
+    def compact(self):
+        """Remove from the index the venvs that are not alive, and shrink the database."""
+        with self.conn:
+            cursor = self.conn.execute("SELECT id, metadata FROM venvs")
+            ids = [(venv_id,) for venv_id, metadata in cursor.fetchall()
+                   if not self.is_alive(json.loads(metadata))]
+            self.conn.executemany("DELETE FROM installed WHERE venv_id = ?", ids)
+            self.conn.executemany("DELETE FROM venvs WHERE id = ?", ids)
+        logger.debug("Removed %d dead venvs from index", len(ids))
+        self.conn.execute("VACUUM")
+
+    def _remove(self, env_paths):
+        """Remove the venvs from the index."""
+        with self.conn:
+            cursor = self.conn.execute("SELECT id, metadata FROM venvs")
+            ids = [(venv_id,) for venv_id, metadata in cursor.fetchall()
+                   if json.loads(metadata)['env_path'] in env_paths]
+            self.conn.executemany("DELETE FROM installed WHERE venv_id = ?", ids)
+            self.conn.executemany("DELETE FROM venvs WHERE id = ?", ids)
+
+    def _get_installed(self, venv_id):
+        """Return what the venv has installed, keyed by repo and then by project."""
+        installed = {}
+        cursor = self.conn.execute(
+            "SELECT repo, project, version FROM installed WHERE venv_id = ?", (venv_id,))
+        for repo, project, version in cursor:
+            installed.setdefault(repo, {})[project] = version
+        return installed
+
+    def _iter_entries(self):
+        """Yield each venv in the index, with its installed packages already built."""
+        cursor = self.conn.execute("SELECT id, metadata FROM venvs ORDER BY id")
+        for venv_id, metadata in cursor.fetchall():
+            installed = self._get_installed(venv_id)
+            venv = {'installed': installed, 'metadata': json.loads(metadata)}
+            yield self._build_installed(installed), venv
+
+    def get_venv(self, requirements):
+        """Find a venv that serves these requirements, if any."""
+        venv = self._get_by_fingerprint(requirements)
+        if venv is not None:
+            return venv
+
+        logger.debug("Searching a venv for reqs: %s", requirements)
+        for venv_id in self._get_candidates(requirements):
+            installed = self._get_installed(venv_id)
+            if self._venv_match(self._build_installed(installed), requirements):
+                cursor = self.conn.execute("SELECT metadata FROM venvs WHERE id = ?", (venv_id,))
+                venv = json.loads(cursor.fetchone()[0])
+                logger.debug("Found a matching venv! %s", venv)
+                return venv
+        logger.debug("No matching venv found :(")
+
+    def store(self, installed_stuff, metadata, requirements=None):
+        """Store the virtualenv metadata for the indicated installed_stuff."""
+        logger.debug("Storing installed=%s metadata=%s", installed_stuff, metadata)
+        fingerprint = None if requirements is None else get_fingerprint(requirements)
+        with self.conn:
+            self._insert(int(time.mktime(time.localtime())),
+                         installed_stuff, metadata, fingerprint)
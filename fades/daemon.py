@@ -0,0 +1,156 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General
+# Public License version 3, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""A long lived fades process that answers which venv to use for a script.
+
+The daemon keeps the venvs index and the parsed scripts in memory, and
+answers through a Unix socket in the fades base directory. The protocol is
+a JSON line per request and response: the client sends the (absolute) path
+of the child program, and receives the metadata of the venv to use for it,
+or null if there is none (so the client needs to create it).
+
+If the daemon is not running (or anything fails talking to it), the client
+just does everything by itself.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import time
+
+logger = logging.getLogger(__name__)
+
+SOCKET_NAME = 'daemon.sock'
+
+# how much the client waits for the daemon, before doing all by itself
+CLIENT_TIMEOUT = 5
+
+# how often (in seconds) the daemon forgets the scripts that don't exist anymore
+PRUNE_INTERVAL = 60
+
+
+def get_socket_path(basedir):
+    """Return the path of the daemon socket."""
+    return os.path.join(basedir, SOCKET_NAME)
+
+
+def get_venv(socket_path, child_program):
+    """Ask the daemon for the venv of the child program; None if can't tell."""
+    if not os.path.exists(socket_path):
+        return
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            request = {'child_program': os.path.abspath(child_program)}
+            sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+            with sock.makefile('rb') as fh:
+                response = json.loads(fh.readline().decode('utf8'))
+    except (OSError, ValueError) as error:
+        logger.debug("Couldn't ask the daemon: %s", error)
+        return
+
+    if 'error' in response:
+        logger.debug("The daemon couldn't answer: %s", response['error'])
+        return
+    logger.debug("Venv from the daemon: %s", response['venv'])
+    return response['venv']
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Answer one request from a client."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf8'))
+            response = {'venv': self.server.get_venv(request['child_program'])}
+        except Exception as error:
+            logger.exception("Error answering the request")
+            response = {'error': str(error)}
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+class FadesServer(socketserver.UnixStreamServer):
+    """The daemon itself, keeping the index and the parsed scripts in memory."""
+
+    def __init__(self, socket_path, basedir):
+        # not imported at module level, so the client side starts fast
+        from fades import cache, parsing
+        self._parsing = parsing
+        self.venvscache = cache.VEnvsCache(os.path.join(basedir, 'venvs.idx'))
+        self._parsed = {}  # child program path -> (signature, requirements)
+        self._last_prune = time.monotonic()
+
+        # a socket left by a daemon not cleanly stopped would not let us bind
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def _parse(self, child_program):
+        """Parse the child program, if it changed since the last time."""
+        try:
+            signature = self._parsing._get_file_signature(child_program)
+        except OSError:
+            self._parsed.pop(child_program, None)
+            raise
+        previous = self._parsed.get(child_program)
+        if previous is not None and previous[0] == signature:
+            return previous[1]
+        requirements = self._parsing.parse_file(child_program)
+        self._parsed[child_program] = (signature, requirements)
+        return requirements
+
+    def get_venv(self, child_program):
+        """Return the venv for the child program, None if there is none."""
+        requirements = self._parse(child_program)
+        venv_data = self.venvscache.get_venv(requirements)
+        if venv_data is not None:
+            self.venvscache.mark_used(venv_data)
+        return venv_data
+
+    def service_actions(self):
+        """Forget, from time to time, the parsed scripts that don't exist anymore."""
+        now = time.monotonic()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        for child_program in list(self._parsed):
+            if not os.path.exists(child_program):
+                del self._parsed[child_program]
+
+    def server_close(self):
+        """Close the server and remove its socket."""
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def serve(socket_path, basedir):
+    """Run the daemon until interrupted."""
+    os.makedirs(basedir, exist_ok=True)
+    with FadesServer(socket_path, basedir) as server:
+        logger.info("Daemon answering in %r", socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Daemon stopped")
@@ -19,28 +19,151 @@
 NOTE: this class only work in the same python version that Fades is
 running. So, you don't need to have installed a virtualenv tool. For
 other python versions Fades needs a virtualenv tool installed.
+
+As creating a venv from scratch is slow (specially installing pip in it), a
+pristine venv is built only once per interpreter as a template, and then
+each new venv is just a clone of it.
 """
 
+import hashlib
 import logging
 import os
+import shutil
+import sys
+import time
 
 from venv import EnvBuilder
 from uuid import uuid4
 
-from fades import REPO_PYPI
-from fades.helpers import get_basedir
+try:
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # way slower to import, but always there with setuptools
+    from pkg_resources.extern.packaging.utils import canonicalize_name
+
+from fades import REPO_PYPI, timing
+from fades.helpers import get_basedir, get_site_packages, is_hardlinked
 from fades.pipmanager import PipManager
+from fades.pkgstore import PackagesStore
+from fades.resolutions import is_loose
 
 
 logger = logging.getLogger(__name__)
 
+# after this time (in seconds) a template directory without its symlink is surely not being built
+TEMPLATE_BUILD_TIMEOUT = 24 * 3600
+
+
+def _link_or_copy(src, dst):
+    """Hardlink the file if possible, copy it if not."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def clone_venv(src_path, dst_path):
+    """Create a venv cloning other one, fixing the paths inside it.
+
+    The files are hardlinked if possible, so the clone is fast and takes almost no
+    space; the ones that have the original venv path in them are really copied,
+    with the path replaced.
+    """
+    logger.debug("Cloning venv %r into %r", src_path, dst_path)
+    shutil.copytree(src_path, dst_path, symlinks=True, copy_function=_link_or_copy)
+
+    bin_path = os.path.join(dst_path, 'bin')
+    to_fix = [os.path.join(dst_path, 'pyvenv.cfg')]
+    to_fix.extend(os.path.join(bin_path, fname) for fname in os.listdir(bin_path))
+    src_bytes = os.fsencode(src_path)
+    dst_bytes = os.fsencode(dst_path)
+    for path in to_fix:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as fh:
+            content = fh.read()
+        if src_bytes not in content:
+            continue
+
+        # remove it first so the hardlink is broken and the original is not touched
+        os.remove(path)
+        with open(path, 'wb') as fh:
+            fh.write(content.replace(src_bytes, dst_bytes))
+        shutil.copystat(os.path.join(src_path, os.path.relpath(path, dst_path)), path)
+
+
+def get_template_path(basedir):
+    """Return the path of the template venv for the interpreter being used."""
+    interpreter_id = hashlib.sha256(
+        (sys.executable + sys.version).encode('utf8')).hexdigest()[:16]
+    return os.path.join(basedir, 'templates', 'python{}.{}-{}'.format(
+        sys.version_info[0], sys.version_info[1], interpreter_id))
+
+
+def prune_templates(basedir):
+    """Remove the templates of other interpreters that no venv was cloned from.
+
+    Also the template directories left without their symlink (from a build that was
+    interrupted), once they are old enough to not be the ones being built now.
+    """
+    templates_dir = os.path.join(basedir, 'templates')
+    try:
+        fnames = os.listdir(templates_dir)
+    except FileNotFoundError:
+        return
+    current = os.path.basename(get_template_path(basedir))
+    linked = set()
+    for fname in fnames:
+        template_path = os.path.join(templates_dir, fname)
+        if not os.path.islink(template_path):
+            continue
+        build_name = os.readlink(template_path)
+        if fname == current or is_hardlinked(os.path.join(templates_dir, build_name)):
+            linked.add(build_name)
+            continue
+        logger.debug("Removing template venv not used anymore: %r", template_path)
+        os.remove(template_path)
+        shutil.rmtree(os.path.join(templates_dir, build_name), ignore_errors=True)
+
+    too_old = time.time() - TEMPLATE_BUILD_TIMEOUT
+    for fname in fnames:
+        build_path = os.path.join(templates_dir, fname)
+        if fname in linked or os.path.islink(build_path):
+            continue
+        try:
+            if os.stat(build_path).st_mtime > too_old:
+                continue
+        except FileNotFoundError:
+            continue
+        logger.debug("Removing template venv interrupted while building: %r", build_path)
+        shutil.rmtree(build_path, ignore_errors=True)
+
+
+def get_added_versions(env_bin_path):
+    """Return the version of everything installed in the venv that didn't come with the template.
+
+    Keyed by project, as PipManager.get_installed_versions() does.
+    """
+    installed = PipManager(env_bin_path).get_installed_versions()
+    template_bin_path = os.path.join(get_template_path(get_basedir()), 'bin')
+    if not os.path.exists(template_bin_path):
+        return installed
+    base = {canonicalize_name(project): version for project, version
+            in PipManager(template_bin_path).get_installed_versions().items()}
+    return {project: version for project, version in installed.items()
+            if base.get(canonicalize_name(project)) != version}
+
 
 class FadesEnvBuilder(EnvBuilder):
     """Create always a virtualenv"""
-    def __init__(self):
+    def __init__(self, use_template=True):
         basedir = get_basedir()
         self.env_path = os.path.join(basedir, str(uuid4()))
         self.env_bin_path = ''
+        self.use_template = use_template
+
+        # the template is specific for the interpreter being used
+        self.template_path = get_template_path(basedir)
         logger.debug("Env will be created at: %s", self.env_path)
 
         # try to install pip using default machinery (which will work in a lot
@@ -57,9 +180,45 @@ class FadesEnvBuilder(EnvBuilder):
         else:
             super().__init__(with_pip=False)
 
-    def create_env(self):
-        """Create the virtualenv and return its info."""
-        self.create(self.env_path)
+    def _get_template(self):
+        """Return the real path of the template venv, building it if needed.
+
+        The template is built in a unique directory, and then a symlink with the
+        template name is created pointing to it; so it's never used half built, and
+        if several processes build it at the same time only one wins.
+        """
+        if not os.path.exists(self.template_path):
+            logger.debug("Building template venv in %r", self.template_path)
+            os.makedirs(os.path.dirname(self.template_path), exist_ok=True)
+            build_path = "{}-{}".format(self.template_path, uuid4())
+            self.create(build_path)
+            try:
+                os.symlink(os.path.basename(build_path), self.template_path)
+            except FileExistsError:
+                logger.debug("Other template venv was built at the same time, using that one")
+                shutil.rmtree(build_path)
+        return os.path.realpath(self.template_path)
+
+    def create_env(self, source=None):
+        """Create the virtualenv and return its info.
+
+        If a source venv path is given, the new one is a clone of it (instead of the
+        template's).
+        """
+        if source is None and self.use_template:
+            source = self._get_template()
+
+        if source is None:
+            self.create(self.env_path)
+        else:
+            try:
+                clone_venv(source, self.env_path)
+            except OSError as error:
+                logger.warning("Couldn't clone the venv %r (%s), creating it", source, error)
+                shutil.rmtree(self.env_path, ignore_errors=True)
+                self.create(self.env_path)
+            else:
+                self.env_bin_path = os.path.join(self.env_path, 'bin')
         logger.debug("env_bin_path: %s", self.env_bin_path)
         return self.env_path, self.env_bin_path, self.pip_installed
 
@@ -68,36 +227,127 @@ class FadesEnvBuilder(EnvBuilder):
         self.env_bin_path = context.bin_path
 
 
-def create_venv(requested_deps):
-    """Create a new virtualvenv with the requirements of this script."""
-    # create virtualenv
+def _create_env(base):
+    """Create the venv (a clone of the base one if given), return its data and what it has."""
     env = FadesEnvBuilder()
-    env_path, env_bin_path, pip_installed = env.create_env()
+    if base is None:
+        with timing.span("create_env"):
+            env_path, env_bin_path, pip_installed = env.create_env()
+        installed = {}
+    else:
+        base_data, base_installed = base
+        with timing.span("create_env"):
+            env_path, env_bin_path, pip_installed = env.create_env(base_data['env_path'])
+        installed = {repo: dict(deps) for repo, deps in base_installed.items()}
     venv_data = {}
     venv_data['env_path'] = env_path
     venv_data['env_bin_path'] = env_bin_path
     venv_data['pip_installed'] = pip_installed
+    return venv_data, installed
+
 
-    # install deps
-    installed = {}
+def _get_managers(requested_deps, venv_data):
+    """Yield the manager of each repo, with the repo and its requested deps."""
     for repo in requested_deps.keys():
         if repo == REPO_PYPI:
-            mgr = PipManager(env_bin_path, pip_installed=pip_installed)
+            mgr = PipManager(venv_data['env_bin_path'], pip_installed=venv_data['pip_installed'])
         else:
             logger.warning("Install from %r not implemented", repo)
             continue
-        installed[repo] = {}
-
         repo_requested = requested_deps[repo]
         logger.debug("Installing dependencies for repo %r: requested=%s", repo, repo_requested)
-        for dependency in repo_requested:
-            mgr.install(dependency)
+        yield repo, mgr, repo_requested
+
+
+def _update_installed(repo_installed, repo_requested, mgr):
+    """Record the installed versions of what was requested."""
+    # always store the installed dependency, as in the future we'll select the venv
+    # based on what is installed, not what used requested (remember that user may
+    # request >, >=, etc!)
+    versions = {canonicalize_name(project): version
+                for project, version in mgr.get_installed_versions().items()}
+    for dependency in repo_requested:
+        project = dependency.name
+        try:
+            repo_installed[project] = versions[canonicalize_name(project)]
+        except KeyError:
+            logger.warning("Couldn't get the installed version of %r", project)
+    logger.debug("Installed dependencies: %s", repo_installed)
+
+
+def _share_packages(venv_data):
+    """Share what was installed in the venv with the other venvs."""
+    PackagesStore(get_basedir()).share(get_site_packages(venv_data['env_path']))
+
+
+def _pin(repo_requested, resolutions):
+    """Return what to install for the requested deps, pinned to their known resolutions."""
+    if resolutions is None:
+        return repo_requested
+    return resolutions.pin(repo_requested)
+
+
+def _needs_resolving(repo_requested, to_install, resolutions):
+    """Tell if there are loose deps without a known resolution, so pip must ask the index.
+
+    Without a resolutions cache, whatever is in the wheelhouse is good enough.
+    """
+    if resolutions is None:
+        return False
+    return any(dependency is installed_as and is_loose(dependency)
+               for dependency, installed_as in zip(repo_requested, to_install))
+
+
+def _store_resolutions(repo_requested, to_install, repo_installed, resolutions):
+    """Remember the versions resolved for the deps that were not pinned."""
+    if resolutions is not None:
+        resolved = [dependency for dependency, installed_as in zip(repo_requested, to_install)
+                    if dependency is installed_as]
+        resolutions.store(resolved, repo_installed)
+
+
+def create_venv(requested_deps, base=None, resolutions=None, no_deps=False):
+    """Create a new virtualvenv with the requirements of this script.
+
+    If a base venv is given (its data and what it has installed), the new one
+    is a clone of it, so the requested deps are only the ones it's missing.
+
+    If a resolutions cache is given, the deps are installed pinned to the versions
+    there; for the loose ones that are not there pip asks the index (not using
+    what the wheelhouse has), and the resolved versions are stored in it.
+
+    With no_deps, only the requested deps are installed (not their dependencies).
+    """
+    venv_data, installed = _create_env(base)
+    for repo, mgr, repo_requested in _get_managers(requested_deps, venv_data):
+        to_install = _pin(repo_requested, resolutions)
+        resolve = _needs_resolving(repo_requested, to_install, resolutions)
+        mgr.install(*to_install, no_deps=no_deps, resolve=resolve)
+        _update_installed(installed.setdefault(repo, {}), repo_requested, mgr)
+        _store_resolutions(repo_requested, to_install, installed[repo], resolutions)
+    _share_packages(venv_data)
+    return venv_data, installed
+
 
-            # always store the installed dependency, as in the future we'll select the venv
-            # based on what is installed, not what used requested (remember that user may
-            # request >, >=, etc!)
-            project = dependency.project_name
-            installed[repo][project] = mgr.get_version(project)
+async def async_create_venv(requested_deps, base=None, resolutions=None):
+    """Create a new virtualenv as create_venv() does, but without blocking the event loop.
 
-        logger.debug("Installed dependencies: %s", installed)
+    So several venvs can be created at the same time from the same process. If
+    cancelled (or anything fails) the half built venv is removed.
+    """
+    import asyncio
+    loop = asyncio.get_event_loop()
+    venv_data, installed = await loop.run_in_executor(None, _create_env, base)
+    try:
+        for repo, mgr, repo_requested in _get_managers(requested_deps, venv_data):
+            to_install = _pin(repo_requested, resolutions)
+            resolve = _needs_resolving(repo_requested, to_install, resolutions)
+            await mgr.async_install(*to_install, resolve=resolve)
+            _update_installed(installed.setdefault(repo, {}), repo_requested, mgr)
+            _store_resolutions(repo_requested, to_install, installed[repo], resolutions)
+        await loop.run_in_executor(None, _share_packages, venv_data)
+    except BaseException:
+        logger.debug("Removing the venv not finished: %r", venv_data['env_path'])
+        shutil.rmtree(venv_data['env_path'], ignore_errors=True)
+        raise
     return venv_data, installed
@@ -17,7 +17,11 @@
 """A collection of utilities for fades."""
 
 import os
+import sys
+import fcntl
 import logging
+import tempfile
+import contextlib
 import subprocess
 
 logger = logging.getLogger(__name__)
@@ -35,6 +39,32 @@ def logged_exec(cmd):
         raise subprocess.CalledProcessError(retcode, cmd)
 
 
+async def async_logged_exec(cmd):
+    """Execute a command without blocking the event loop, redirecting the output to the log.
+
+    If cancelled, the command is killed.
+    """
+    import asyncio  # slow to import, and only needed when preparing venvs
+    logger = logging.getLogger('fades.exec')
+    logger.debug("Executing external command: %r", cmd)
+    p = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        while True:
+            line = await p.stdout.readline()
+            if not line:
+                break
+            logger.debug(":: " + line.rstrip(b"\n").decode("utf8"))
+        retcode = await p.wait()
+    except asyncio.CancelledError:
+        logger.debug("Cancelled, killing external command: %r", cmd)
+        p.kill()
+        await p.wait()
+        raise
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+
+
 def get_basedir():
     """Get the base fades directory, from xdg or kinda hardcoded."""
     try:
@@ -44,3 +74,94 @@ def get_basedir():
         logger.debug("Package xdg not installed; using ~/.fades folder")
         from os.path import expanduser
         return expanduser("~/.fades")
+
+
+def get_site_packages(env_path):
+    """Get the site-packages directory of a venv (of the same Python that runs fades)."""
+    return os.path.join(env_path, "lib", "python%d.%d" % sys.version_info[:2], "site-packages")
+
+
+def read_name_version(metadata_path):
+    """Get the name and version of a package from its metadata (PKG-INFO/METADATA) headers."""
+    name = version = None
+    with open(metadata_path, 'rt', encoding='utf8', errors='replace') as fh:
+        for line in fh:
+            if not line.strip():
+                # end of headers
+                break
+            key, _, value = line.partition(":")
+            if key == "Name":
+                name = value.strip()
+            elif key == "Version":
+                version = value.strip()
+    return name, version
+
+
+def _is_current_lock(fh, lock_path):
+    """Tell if the opened lock file is still the one in the lock path."""
+    try:
+        return os.path.samestat(os.fstat(fh.fileno()), os.stat(lock_path))
+    except FileNotFoundError:
+        return False
+
+
+@contextlib.contextmanager
+def locked(lock_path):
+    """Hold an exclusive lock (shared by all processes) while in this context."""
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    while True:
+        fh = open(lock_path, 'ab')
+        logger.debug("Acquiring lock %r", lock_path)
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        if _is_current_lock(fh, lock_path):
+            break
+        # the lock file was removed while waiting for it, lock the new one
+        fh.close()
+    try:
+        yield
+    finally:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+        logger.debug("Released lock %r", lock_path)
+
+
+def remove_lock(lock_path):
+    """Remove the lock file if it's not held by anybody; return if it was removed."""
+    with open(lock_path, 'ab') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            if _is_current_lock(fh, lock_path):
+                os.remove(lock_path)
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+    return True
+
+
+def is_hardlinked(dirpath):
+    """Tell if any file inside the directory is also hardlinked from other place."""
+    for root, _, filenames in os.walk(dirpath):
+        for fname in filenames:
+            try:
+                if os.lstat(os.path.join(root, fname)).st_nlink > 1:
+                    return True
+            except FileNotFoundError:
+                continue
+    return False
+
+
+def atomic_write(filepath, content):
+    """Write the content to the file, so it's never seen (or left) partially written."""
+    dirpath = os.path.dirname(filepath)
+    fd, temp_path = tempfile.mkstemp(dir=dirpath, prefix=".tmp-")
+    try:
+        with open(fd, 'wt', encoding='utf8') as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
@@ -0,0 +1,98 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Lock files of the child programs, with the exact versions installed for them.
+
+The lock of a child program records everything that is installed in its
+venv (the dependencies of the dependencies too) and the venv itself, so it
+is used directly, and if it's gone it is created again installing exactly
+the same, without resolving anything.
+
+The locks are kept in the base directory (keyed by the child program's
+path), and are not used anymore when the marked dependencies change.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+try:
+    from packaging.requirements import Requirement
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # way slower to import, but always there with setuptools
+    from pkg_resources.extern.packaging.requirements import Requirement
+    from pkg_resources.extern.packaging.utils import canonicalize_name
+
+from fades.cache import get_fingerprint
+from fades.helpers import atomic_write
+
+logger = logging.getLogger(__name__)
+
+LOCKS_DIR = 'lockfiles'
+
+
+def get_path(basedir, child_program):
+    """Return the path of the lock file for the child program."""
+    key = hashlib.sha256(os.path.abspath(child_program).encode('utf8')).hexdigest()
+    return os.path.join(basedir, LOCKS_DIR, key + '.json')
+
+
+def read(filepath, requirements):
+    """Return the lock, None if there isn't one for these requirements."""
+    try:
+        with open(filepath, 'rt', encoding='utf8') as fh:
+            lock = json.load(fh)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        logger.warning("Ignoring broken lock file %r", filepath)
+        return
+    if lock.get('fingerprint') != get_fingerprint(requirements):
+        logger.debug("The dependencies changed, lock file %r not used", filepath)
+        return
+    return lock
+
+
+def write(filepath, requirements, installed, metadata):
+    """Write the lock with what is installed in the venv for these requirements."""
+    lock = {
+        'fingerprint': get_fingerprint(requirements),
+        'installed': installed,
+        'metadata': metadata,
+    }
+    logger.debug("Writing lock file %r: %s", filepath, lock)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    atomic_write(filepath, json.dumps(lock, indent=2, sort_keys=True))
+
+
+def get_installed(lock, requirements):
+    """Return the locked versions of only the required projects (as the venvs index has)."""
+    installed = {}
+    for repo, reqs in requirements.items():
+        required = {canonicalize_name(req.name) for req in reqs}
+        installed[repo] = {project: version
+                           for project, version in lock['installed'].get(repo, {}).items()
+                           if canonicalize_name(project) in required}
+    return installed
+
+
+def get_pinned(lock):
+    """Return the requirements to install exactly what the lock has."""
+    return {repo: [Requirement("{}=={}".format(project, version))
+                   for project, version in sorted(versions.items())]
+            for repo, versions in lock['installed'].items()}
@@ -20,9 +20,10 @@
 import os
 import sys
 import logging
+import contextlib
 import subprocess
 
-from fades import parsing, logger, cache, helpers, envbuilder
+from fades import REPO_PYPI, logger, helpers, daemon, timing
 
 
 USAGE = """
@@ -35,10 +36,58 @@ Usage:  fades [<fades_options>] child_program [<child_program_options>]
                       may be very useful if any problem arises.
         -q|--quiet:   don't show anything (unless it has a real problem),
                       so the original script stderr is not polluted at all.
+        -x|--exec:    replace fades with the child program (instead of
+                      running it as a subprocess), so no fades process
+                      is left behind while the child program runs.
+        --extend:     if no virtualenv has all the needed dependencies,
+                      create one cloning the virtualenv that has the
+                      most of them (and nothing else), installing only
+                      what is missing.
+        --sqlite-index: keep the virtualenvs index in a SQLite database
+                      (the previous index is migrated automatically).
+        --gc:         clean the virtualenvs index, remove the least
+                      recently used virtualenvs to satisfy the limits
+                      indicated with the following options, and quit (no
+                      child program is needed). If these options are used
+                      while running a child program, the old virtualenvs
+                      are removed every time a new one is created.
+        --gc-max-age=DAYS: remove the virtualenvs not used in that many days.
+        --gc-max-count=N: keep only the N most recently used virtualenvs.
+        --gc-max-size=MB: keep the most recently used virtualenvs that
+                      together take at most that many megabytes.
+        --daemon:     run the fades daemon (until interrupted), that keeps
+                      the virtualenvs index and the parsed child programs
+                      in memory, so fades starts faster when the child
+                      program already has a virtualenv; it's used
+                      automatically if running (no child program is
+                      needed for this option).
+        --prepare:    don't run the child program, just create (if missing)
+                      the virtualenvs it needs; the child program options
+                      are also scripts to prepare, and for directories all
+                      the Python files inside them are prepared.
+        --workers=N:  how many virtualenvs to create at the same time when
+                      preparing them (by default, one per CPU).
+        --resolution-ttl=HOURS: for how long the versions that were installed
+                      for loose requirements (like 'foo >= 2') are used again
+                      for them, without asking the packages index (by
+                      default, 24 hours; 0 to always ask).
+        --lock:       use (or write, the first time) a lock file for the
+                      child program, with the exact versions of everything
+                      installed in its virtualenv; if the virtualenv is
+                      gone, the same versions are installed again without
+                      resolving the dependencies (the lock is written again
+                      if the marked dependencies change).
+        --header-only: look for the marked dependencies only in the child
+                      program's header: up to the first statement that is
+                      not an import (or the docstring), which is faster for
+                      long programs.
+        --timing-report=FILE: write in that file (as JSON) how long took
+                      each phase of what fades did (up to launching the
+                      child program); a summary is always shown with -v.
 
     The "child program" is the script that fades will execute. It's a
-    mandatory parameter, the first thing received by fades that is not
-    a parameter.
+    mandatory parameter (except for --gc and --daemon), the first thing
+    received by fades that is not a parameter.
 
     The child program options (everything after the child program) are
     parameters passed as is to the child program.
@@ -71,6 +120,248 @@ def _parse_argv(argv):
     return fades_options, child_program, argv[1:]
 
 
+def _get_option_value(fades_options, name):
+    """Return the value of an option given as '--name=value', None if not there."""
+    prefix = name + "="
+    for option in fades_options:
+        if option.startswith(prefix):
+            return option[len(prefix):]
+
+
+def _get_gc_limits(fades_options):
+    """Return the limits for the venvs garbage collection, converted to what cache needs.
+
+    Raise ValueError if any of them is not a valid number.
+    """
+    limits = {}
+    max_age = _get_option_value(fades_options, "--gc-max-age")
+    if max_age is not None:
+        limits['max_age'] = float(max_age) * 24 * 60 * 60
+    max_count = _get_option_value(fades_options, "--gc-max-count")
+    if max_count is not None:
+        limits['max_count'] = int(max_count)
+    max_size = _get_option_value(fades_options, "--gc-max-size")
+    if max_size is not None:
+        limits['max_size'] = float(max_size) * 1024 * 1024
+    return limits
+
+
+def _get_workers(fades_options):
+    """Return how many venvs to create at the same time when preparing them.
+
+    Raise ValueError if it's not a valid number (at least one).
+    """
+    workers = _get_option_value(fades_options, "--workers")
+    if workers is None:
+        return os.cpu_count() or 1
+    workers = int(workers)
+    if workers < 1:
+        raise ValueError("at least one worker is needed")
+    return workers
+
+
+def _get_resolution_ttl(fades_options):
+    """Return how long (in seconds) the resolved versions are used; None for the default.
+
+    Raise ValueError if it's not a valid number.
+    """
+    ttl = _get_option_value(fades_options, "--resolution-ttl")
+    if ttl is not None:
+        return float(ttl) * 60 * 60
+
+
+def _get_resolutions(fades_options):
+    """Return the cache of the versions resolved for the requirements."""
+    from fades import resolutions
+    filepath = os.path.join(helpers.get_basedir(), 'resolutions.json')
+    ttl = _get_resolution_ttl(fades_options)
+    if ttl is None:
+        return resolutions.ResolutionsCache(filepath)
+    return resolutions.ResolutionsCache(filepath, ttl)
+
+
+def _run_child(python_exe, child_program, child_options, replace_process=False,
+               timing_report=None):
+    """Run the child program, replacing the current process if indicated.
+
+    The timing of fades is reported right after launching the child program (or
+    before replacing the process with it).
+    """
+    l = logging.getLogger('fades')
+    cmd = [python_exe, child_program] + child_options
+    if replace_process:
+        l.debug("Replacing fades with the child Python program")
+        timing.report(timing_report)
+        # nothing will be logged after this, flush everything
+        logging.shutdown()
+        os.execv(python_exe, cmd)
+
+    with timing.span("child launch"):
+        p = subprocess.Popen(cmd)
+    timing.report(timing_report)
+    rc = p.wait()
+    if rc:
+        l.debug("Child process not finished correctly: returncode=%d", rc)
+    return rc
+
+
+def _get_venv(venvscache, requested_deps, fades_options, gc_limits):
+    """Get the venv for the requested dependencies, creating it if needed."""
+    installed = None
+    with venvscache.lock(requested_deps):
+        with timing.span("get_venv"):
+            venv_data = venvscache.get_venv(requested_deps)
+        if venv_data is None:
+            # not imported at start up, as it's only needed if there is no venv to reuse
+            from fades import envbuilder
+            to_extend = None
+            if "--extend" in fades_options:
+                to_extend = venvscache.get_venv_to_extend(requested_deps)
+            resolutions = _get_resolutions(fades_options)
+            if to_extend is None:
+                venv_data, installed = envbuilder.create_venv(
+                    requested_deps, resolutions=resolutions)
+            else:
+                base_data, base_installed, missing_deps = to_extend
+                venv_data, installed = envbuilder.create_venv(
+                    missing_deps, base=(base_data, base_installed), resolutions=resolutions)
+            # store this new venv in the cache
+            venvscache.store(installed, venv_data, requested_deps)
+        else:
+            venvscache.mark_used(venv_data)
+
+    # new venv created, maybe old ones need to go
+    if installed is not None and gc_limits:
+        venvscache.collect(**gc_limits)
+    return venv_data
+
+
+def _get_locked_venv(venvscache, requested_deps, lock_path, fades_options, gc_limits):
+    """Get the venv of the child program's lock file, writing the lock if needed.
+
+    The venv in the lock is used directly (without looking at the index); if it's
+    gone, a new one is created installing exactly what the lock has. What comes
+    with the template venv (like pip itself) is not locked.
+    """
+    from fades import lockfile
+    lock = lockfile.read(lock_path, requested_deps)
+    if lock is None:
+        from fades import envbuilder
+        venv_data = _get_venv(venvscache, requested_deps, fades_options, gc_limits)
+        installed = envbuilder.get_added_versions(venv_data['env_bin_path'])
+        lockfile.write(lock_path, requested_deps, {REPO_PYPI: installed}, venv_data)
+        return venv_data
+
+    if venvscache.is_alive(lock['metadata']):
+        l = logging.getLogger('fades')
+        l.debug("Using the venv from the lock file: %s", lock['metadata'])
+        venvscache.mark_used(lock['metadata'])
+        return lock['metadata']
+
+    with venvscache.lock(requested_deps):
+        # other fades may have created it while waiting
+        lock = lockfile.read(lock_path, requested_deps) or lock
+        if venvscache.is_alive(lock['metadata']):
+            return lock['metadata']
+        from fades import envbuilder
+        venv_data, _ = envbuilder.create_venv(lockfile.get_pinned(lock), no_deps=True)
+        # as any other venv, indexed by the versions of what was required
+        venvscache.store(lockfile.get_installed(lock, requested_deps), venv_data, requested_deps)
+        lockfile.write(lock_path, requested_deps, lock['installed'], venv_data)
+
+    if gc_limits:
+        venvscache.collect(**gc_limits)
+    return venv_data
+
+
+def _find_scripts(paths):
+    """Return the scripts in the paths, walking the directories for Python files."""
+    scripts = []
+    for path in paths:
+        if not os.path.isdir(path):
+            scripts.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            scripts.extend(os.path.join(dirpath, fname)
+                           for fname in sorted(filenames) if fname.endswith('.py'))
+    return scripts
+
+
+async def _prepare_venv(venvscache, requested_deps, fades_options, semaphore):
+    """Get the venv for the requested dependencies, creating it (concurrently) if needed."""
+    import asyncio
+    from fades import envbuilder
+    loop = asyncio.get_event_loop()
+    async with semaphore:
+        with contextlib.ExitStack() as stack:
+            # other fades may be creating this venv, wait for it without blocking the others
+            await loop.run_in_executor(None, stack.enter_context, venvscache.lock(requested_deps))
+            if venvscache.get_venv(requested_deps) is not None:
+                return
+
+            to_extend = None
+            if "--extend" in fades_options:
+                to_extend = venvscache.get_venv_to_extend(requested_deps)
+            resolutions = _get_resolutions(fades_options)
+            if to_extend is None:
+                venv_data, installed = await envbuilder.async_create_venv(
+                    requested_deps, resolutions=resolutions)
+            else:
+                base_data, base_installed, missing_deps = to_extend
+                venv_data, installed = await envbuilder.async_create_venv(
+                    missing_deps, base=(base_data, base_installed), resolutions=resolutions)
+            venvscache.store(installed, venv_data, requested_deps)
+
+
+async def _prepare_venvs(venvscache, all_requested_deps, fades_options, workers):
+    """Prepare the venvs concurrently, at most that many workers at the same time.
+
+    Return the result of each one (the exception, if it failed).
+    """
+    import asyncio
+    semaphore = asyncio.Semaphore(workers)
+    return await asyncio.gather(
+        *(_prepare_venv(venvscache, requested_deps, fades_options, semaphore)
+          for requested_deps in all_requested_deps), return_exceptions=True)
+
+
+def _prepare(venvscache, scripts, parsed_dir, fades_options, workers):
+    """Get the venvs for all the scripts, creating the missing ones in parallel.
+
+    Return how many venvs couldn't be created.
+    """
+    # not imported at start up, as it's slow to import and only needed here
+    import asyncio
+    from fades import cache, parsing
+    l = logging.getLogger('fades')
+
+    # different scripts may need the same, create those venvs only once
+    to_prepare = {}
+    failed = 0
+    for script in scripts:
+        try:
+            with timing.span("parse_file " + script):
+                requested_deps = parsing.parse_file(
+                    script, parsed_dir, header_only="--header-only" in fades_options)
+        except (OSError, ValueError) as error:
+            l.error("Couldn't parse %r: %s", script, error)
+            failed += 1
+            continue
+        to_prepare.setdefault(cache.get_fingerprint(requested_deps), requested_deps)
+    l.info("Preparing virtualenvs for %d scripts (%d different sets of dependencies)",
+           len(scripts), len(to_prepare))
+
+    all_requested_deps = list(to_prepare.values())
+    results = asyncio.run(
+        _prepare_venvs(venvscache, all_requested_deps, fades_options, workers))
+    for requested_deps, result in zip(all_requested_deps, results):
+        if isinstance(result, BaseException):
+            l.error("Couldn't create the virtualenv for %s: %r", requested_deps, result)
+            failed += 1
+    return failed
+
+
 def go(version, argv):
     """Make the magic happen."""
     fades_options, child_program, child_options = _parse_argv(sys.argv)
@@ -84,10 +375,32 @@ def go(version, argv):
     if "-h" in fades_options or "--help" in fades_options:
         print(USAGE)
         sys.exit()
-    if not child_program:
+    collect_only = "--gc" in fades_options
+    run_daemon = "--daemon" in fades_options
+    prepare = "--prepare" in fades_options
+    if not child_program and not collect_only and not run_daemon:
         print("ERROR: the 'child program' is mandatory.")
         print(USAGE)
         sys.exit()
+    try:
+        gc_limits = _get_gc_limits(fades_options)
+    except ValueError:
+        print("ERROR: the limits for the --gc options need to be numbers.")
+        print(USAGE)
+        sys.exit()
+    try:
+        workers = _get_workers(fades_options)
+    except ValueError:
+        print("ERROR: the --workers option needs to be a number, at least 1.")
+        print(USAGE)
+        sys.exit()
+    try:
+        _get_resolution_ttl(fades_options)
+    except ValueError:
+        print("ERROR: the --resolution-ttl option needs to be a number.")
+        print(USAGE)
+        sys.exit()
+    timing_report = _get_option_value(fades_options, "--timing-report")
 
     verbose = "-v" in fades_options or "--verbose" in fades_options
     quiet = "-q" in fades_options or "--quiet" in fades_options
@@ -106,20 +419,60 @@ def go(version, argv):
     if verbose and quiet:
         l.warning("Overriding 'quiet' option ('verbose' also requested)")
 
-    # parse file and get deps
-    requested_deps = parsing.parse_file(child_program)
+    basedir = helpers.get_basedir()
+    if run_daemon:
+        daemon.serve(daemon.get_socket_path(basedir), basedir)
+        return
+
+    # the daemon (if running) may know the venv already, without parsing or reading the index
+    use_sqlite = "--sqlite-index" in fades_options
+    header_only = "--header-only" in fades_options
+    use_lock = "--lock" in fades_options
+    venv_data = None
+    if not (collect_only or prepare or use_sqlite or header_only or use_lock):
+        with timing.span("daemon get_venv"):
+            venv_data = daemon.get_venv(daemon.get_socket_path(basedir), child_program)
 
-    # start the virtualenvs manager
-    venvscache = cache.VEnvsCache(os.path.join(helpers.get_basedir(), 'venvs.idx'))
-    venv_data = venvscache.get_venv(requested_deps)
     if venv_data is None:
-        venv_data, installed = envbuilder.create_venv(requested_deps)
-        # store this new venv in the cache
-        venvscache.store(installed, venv_data)
+        # not imported at start up, as they're not needed if the daemon answered
+        from fades import cache, parsing
+
+        # start the virtualenvs manager
+        index_path = os.path.join(basedir, 'venvs.idx')
+        if use_sqlite:
+            venvscache = cache.SQLiteVEnvsCache(os.path.join(basedir, 'venvs.db'),
+                                                migrate_from=index_path)
+        else:
+            venvscache = cache.VEnvsCache(index_path)
+        if collect_only:
+            venvscache.compact()
+            venvscache.collect(**gc_limits)
+            return
+        parsed_dir = os.path.join(basedir, 'parsed')
+        if prepare:
+            scripts = _find_scripts([child_program] + child_options)
+            failed = _prepare(venvscache, scripts, parsed_dir, fades_options, workers)
+            if gc_limits:
+                venvscache.collect(**gc_limits)
+            timing.report(timing_report)
+            if failed:
+                sys.exit(1)
+            return
+
+        # parse file and get deps
+        with timing.span("parse_file"):
+            requested_deps = parsing.parse_file(
+                child_program, parsed_dir, header_only=header_only)
+        if use_lock:
+            from fades import lockfile
+            venv_data = _get_locked_venv(venvscache, requested_deps,
+                                         lockfile.get_path(basedir, child_program),
+                                         fades_options, gc_limits)
+        else:
+            venv_data = _get_venv(venvscache, requested_deps, fades_options, gc_limits)
 
     # run forest run!!
     l.debug("Calling the child Python program %r with options %s", child_program, child_options)
     python_exe = os.path.join(venv_data['env_bin_path'], "python3")
-    rc = subprocess.call([python_exe, child_program] + child_options)
-    if rc:
-        l.debug("Child process not finished correctly: returncode=%d", rc)
+    replace_process = "-x" in fades_options or "--exec" in fades_options
+    _run_child(python_exe, child_program, child_options, replace_process, timing_report)
@@ -16,14 +16,29 @@
 
 """Script parsing to get needed dependencies."""
 
+import hashlib
+import io
+import json
 import logging
+import mmap
+import os
+import re
+import tokenize
 
-from pkg_resources import parse_requirements
+try:
+    from packaging.requirements import Requirement
+except ImportError:
+    # way slower to import, but always there with setuptools
+    from pkg_resources.extern.packaging.requirements import Requirement
 
 from fades import REPO_PYPI
+from fades.helpers import atomic_write
 
 logger = logging.getLogger(__name__)
 
+# what all the lines with marked dependencies have
+_MARK_RE = re.compile(b'fades')
+
 
 def _parse_content(fh):
     """Parse the content of a script to find marked dependencies."""
@@ -66,7 +81,7 @@ def _parse_content(fh):
             logger.warning("Not understood import info: %s", import_tokens)
             continue
         module = module_path.split(".")[0]
-        # To match the "safe" name that pkg_resources creates:
+        # To match the "safe" name that is used for projects:
         module = module.replace('_', '-')
 
         # get the fades info
@@ -87,13 +102,150 @@ def _parse_content(fh):
             continue
 
         # record the dependency
-        dependency = list(parse_requirements(requirement))[0]
+        dependency = Requirement(requirement)
         deps.setdefault(repo, []).append(dependency)
 
     return deps
 
 
-def parse_file(filepath):
-    """Parse a file and return its marked dependencies."""
-    with open(filepath, 'rt', encoding='utf8') as fh:
-        return _parse_content(fh)
+def _read_marked_lines(filepath):
+    """Return the lines of the file that may mark a dependency, each with the following one.
+
+    The file is scanned as bytes (memory mapped) and only those lines are decoded,
+    so big files with a few marks are read way faster than line by line; the
+    following line is needed for marks in their own line, before the import.
+    """
+    with open(filepath, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # find the regions from the marked lines up to the end of the following
+            # ones, merging them if they touch
+            regions = []
+            line_end = 0
+            for match in _MARK_RE.finditer(mm):
+                if match.start() < line_end:
+                    # other mark in the same line
+                    continue
+                start = mm.rfind(b'\n', 0, match.start()) + 1
+                line_end = mm.find(b'\n', match.end())
+                line_end = len(mm) if line_end == -1 else line_end + 1
+                if mm.find(b'#', start, line_end) == -1:
+                    # not a comment
+                    continue
+                end = mm.find(b'\n', line_end)
+                end = len(mm) if end == -1 else end + 1
+                if regions and start <= regions[-1][1]:
+                    regions[-1][1] = end
+                else:
+                    regions.append([start, end])
+
+            lines = []
+            for start, end in regions:
+                # with the same universal newlines handling than reading the file as text
+                text = mm[start:end].decode('utf8')
+                lines.extend(io.StringIO(text, newline=None))
+    return lines
+
+
+def _read_header_lines(filepath):
+    """Return the lines of the file's header, where the imports are.
+
+    The header ends with the first top level statement that is not an import
+    (or the module's docstring); that statement's line is included too, as it
+    may follow a mark in its own line. Only the header is read from the file.
+    """
+    raw_lines = []
+    with open(filepath, 'rb') as fh:
+        def readline():
+            line = fh.readline()
+            raw_lines.append(line)
+            return line
+
+        encoding = 'utf8'
+        header_end = None
+        new_statement = True
+        first_statement = True
+        try:
+            for token in tokenize.tokenize(readline):
+                if token.type == tokenize.ENCODING:
+                    encoding = token.string
+                elif token.type == tokenize.NEWLINE:
+                    new_statement = True
+                elif new_statement and token.type not in (tokenize.COMMENT, tokenize.NL):
+                    is_import = token.type == tokenize.NAME and token.string in ('import', 'from')
+                    is_docstring = token.type == tokenize.STRING and first_statement
+                    if not (is_import or is_docstring):
+                        header_end = token.start[0]
+                        break
+                    new_statement = first_statement = False
+        except (tokenize.TokenError, SyntaxError) as error:
+            logger.debug("Couldn't find the header of %r, using all of it: %s", filepath, error)
+            raw_lines.extend(fh.readlines())
+
+    if header_end is not None:
+        raw_lines = raw_lines[:header_end]
+    # with the same universal newlines handling than reading the file as text
+    return list(io.StringIO(b''.join(raw_lines).decode(encoding), newline=None))
+
+
+def _get_file_signature(filepath):
+    """Return what identifies the file's content; if it changes, the file needs to be parsed."""
+    stat = os.stat(filepath)
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def _load_parsed(cache_file, signature):
+    """Return the dependencies stored in the cache for the file, if still valid."""
+    try:
+        with open(cache_file, 'rt', encoding='utf8') as fh:
+            parsed = json.load(fh)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        logger.warning("Ignoring broken parse cache file %r", cache_file)
+        return
+    if parsed['signature'] != signature:
+        logger.debug("File changed since it was parsed, need to parse it again")
+        return
+    return {repo: [Requirement(dep) for dep in deps] for repo, deps in parsed['deps'].items()}
+
+
+def _store_parsed(cache_file, signature, deps):
+    """Store the dependencies found in the file, for it to not be parsed again."""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    parsed = {
+        'signature': signature,
+        'deps': {repo: [str(dep) for dep in repo_deps] for repo, repo_deps in deps.items()},
+    }
+    # other fades may be reading it at the same time
+    atomic_write(cache_file, json.dumps(parsed))
+
+
+def parse_file(filepath, cachedir=None, header_only=False):
+    """Parse a file and return its marked dependencies.
+
+    If a cache directory is given, the dependencies found are stored there, keyed by
+    the file path, so the file is not parsed again while it has the same modification
+    time and size.
+
+    If indicated, only the file's header is parsed (see _read_header_lines).
+    """
+    read_lines = _read_header_lines if header_only else _read_marked_lines
+    if cachedir is None:
+        return _parse_content(read_lines(filepath))
+
+    abspath = os.path.abspath(filepath)
+    cache_file = os.path.join(cachedir, hashlib.sha256(abspath.encode('utf8')).hexdigest())
+    signature = _get_file_signature(abspath)
+    if header_only:
+        # what is found in the header may be less than in the whole file
+        signature['header_only'] = True
+    deps = _load_parsed(cache_file, signature)
+    if deps is not None:
+        logger.debug("Using dependencies already parsed for %r: %s", filepath, deps)
+        return deps
+
+    deps = _parse_content(read_lines(filepath))
+    _store_parsed(cache_file, signature, deps)
+    return deps
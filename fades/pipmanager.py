@@ -20,12 +20,13 @@
 
 
 import os
+import glob
 import logging
 import subprocess
 
-from urllib import request
-
-from fades.helpers import logged_exec, get_basedir
+from fades import timing
+from fades.helpers import (
+    async_logged_exec, logged_exec, get_basedir, get_site_packages, read_name_version)
 
 logger = logging.getLogger(__name__)
 
@@ -40,30 +41,133 @@ class PipManager():
         self.pip_exe = os.path.join(self.env_bin_path, "pip")
         basedir = get_basedir()
         self.pip_installer_fname = os.path.join(basedir, "get-pip.py")
+        self.wheelhouse = os.path.join(basedir, "wheels")
 
-    def install(self, dependency):
-        """Install a new dependency."""
-        if not self.pip_installed:
-            logger.info("Need to install a dependency with pip, but no builtin, do it manually")
-            self._brute_force_install_pip()
+    def install(self, *dependencies, no_deps=False, resolve=False):
+        """Install one or more dependencies, all in the same pip call.
+
+        The dependencies are installed from the local wheelhouse (shared by all
+        the venvs); only if they are not there, they are first downloaded (and
+        built if needed) into it.
+
+        With no_deps, only the given dependencies are installed (not what they
+        depend on), for when they are already the whole set to have.
 
-        str_dep = str(dependency)
-        args = [self.pip_exe, "install", str_dep]
-        logger.info("Installing dependency: %s", str_dep)
+        With resolve, the wheelhouse is not tried first: pip asks the packages index
+        which versions to install (and the wheels are got into the wheelhouse).
+        """
+        self._check_pip()
+        str_deps = [str(dependency) for dependency in dependencies]
+        with timing.span("install " + ", ".join(str_deps)):
+            self._install(str_deps, no_deps, resolve)
+
+    def _install(self, str_deps, no_deps=False, resolve=False):
+        """Install the dependencies, getting them into the wheelhouse if needed."""
+        install_args, wheel_args = self._get_install_cmds(str_deps, no_deps)
+        if resolve:
+            logger.debug("Dependencies need to be resolved, asking the index")
+        else:
+            try:
+                logged_exec(install_args)
+            except subprocess.CalledProcessError:
+                logger.debug("Dependencies not (all) in the wheelhouse, need to get them")
+            else:
+                logger.info("Installed dependencies from local wheels: %s", ", ".join(str_deps))
+                return
+
+        logger.info("Installing dependencies: %s", ", ".join(str_deps))
         try:
-            logged_exec(args)
+            logged_exec(wheel_args)
+            logged_exec(install_args)
         except Exception as error:
-            logger.exception("Error installing %s: %s", str_dep, error)
+            logger.exception("Error installing %s: %s", str_deps, error)
             exit()
 
-    def get_version(self, dependency):
-        """Returns the installed version parsing the output of 'pip show'."""
-        logger.debug("getting installed version for %s", dependency)
-        cmd = [self.pip_exe, "show", dependency]
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        version = p.stdout.readlines()[2].decode('utf-8').strip().split()[1]
-        logger.debug("Installed versión of %s is: %s", dependency, version)
-        return version
+    async def async_install(self, *dependencies, resolve=False):
+        """Install the dependencies as install() does, but without blocking the event loop.
+
+        Installation problems are raised, not ended in exit().
+        """
+        import asyncio
+        if not self.pip_installed:
+            # rarely needed, not worth to do it without blocking
+            await asyncio.get_event_loop().run_in_executor(None, self._check_pip)
+        str_deps = [str(dependency) for dependency in dependencies]
+        with timing.span("install " + ", ".join(str_deps)):
+            await self._async_install(str_deps, resolve)
+
+    async def _async_install(self, str_deps, resolve=False):
+        """Install the dependencies without blocking, getting the wheels if needed."""
+        install_args, wheel_args = self._get_install_cmds(str_deps)
+        if resolve:
+            logger.debug("Dependencies need to be resolved, asking the index")
+        else:
+            try:
+                await async_logged_exec(install_args)
+            except subprocess.CalledProcessError:
+                logger.debug("Dependencies not (all) in the wheelhouse, need to get them")
+            else:
+                logger.info("Installed dependencies from local wheels: %s", ", ".join(str_deps))
+                return
+
+        logger.info("Installing dependencies: %s", ", ".join(str_deps))
+        try:
+            await async_logged_exec(wheel_args)
+            await async_logged_exec(install_args)
+        except subprocess.CalledProcessError as error:
+            logger.error("Error installing %s: %s", str_deps, error)
+            raise
+
+    def _check_pip(self):
+        """Install pip in the venv if it isn't there."""
+        if not self.pip_installed:
+            logger.info("Need to install a dependency with pip, but no builtin, do it manually")
+            self._brute_force_install_pip()
+            self.pip_installed = True
+
+    def _get_install_cmds(self, str_deps, no_deps=False):
+        """Return the commands to install from the wheelhouse, and to get the wheels into it."""
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        local_args = ["--no-index", "--find-links", self.wheelhouse]
+        if no_deps:
+            local_args.append("--no-deps")
+        install_args = [self.pip_exe, "install"] + local_args + str_deps
+        wheel_args = [self.pip_exe, "wheel", "--wheel-dir", self.wheelhouse,
+                      "--find-links", self.wheelhouse] + str_deps
+        if no_deps:
+            wheel_args.insert(2, "--no-deps")
+        return install_args, wheel_args
+
+    def get_installed_versions(self):
+        """Return the version of everything installed in the venv, keyed by project.
+
+        This doesn't run pip at all, it reads the metadata that is in the venv's
+        site-packages directory.
+        """
+        site_packages = get_site_packages(os.path.dirname(self.env_bin_path))
+        logger.debug("Reading installed packages metadata from %r", site_packages)
+        versions = {}
+        with timing.span("get installed versions"):
+            for path in glob.glob(os.path.join(site_packages, "*.dist-info")):
+                self._read_metadata(os.path.join(path, "METADATA"), versions)
+            for path in glob.glob(os.path.join(site_packages, "*.egg-info")):
+                if os.path.isdir(path):
+                    path = os.path.join(path, "PKG-INFO")
+                self._read_metadata(path, versions)
+        logger.debug("Installed versions are: %s", versions)
+        return versions
+
+    def _read_metadata(self, filepath, versions):
+        """Get name and version from the metadata headers, storing them in versions."""
+        try:
+            name, version = read_name_version(filepath)
+        except OSError as error:
+            logger.warning("Couldn't read package metadata %r: %s", filepath, error)
+            return
+        if name is None or version is None:
+            logger.warning("No name or version found in package metadata %r", filepath)
+            return
+        versions[name] = version
 
     def _brute_force_install_pip(self):
         """A brute force install of pip itself."""
@@ -72,6 +176,7 @@ class PipManager():
         else:
             logger.debug(
                 "Installer for pip not found in %r, downloading it", self.pip_installer_fname)
+            from urllib import request  # slow to import, and rarely needed
             u = request.urlopen(PIP_INSTALLER)
             with open(self.pip_installer_fname, 'wb') as fh:
                 fh.write(u.read())
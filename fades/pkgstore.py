@@ -0,0 +1,165 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General
+# Public License version 3, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""A store of installed packages, shared by all the venvs.
+
+Each package (project, version and interpreter) is kept once in the store, and
+the files installed in the venvs are replaced by hardlinks to the store ones,
+so the same package in several venvs takes the disk (and page cache) of only
+one copy.
+"""
+
+import csv
+import glob
+import logging
+import os
+import shutil
+import sys
+
+from uuid import uuid4
+
+try:
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # way slower to import, but always there with setuptools
+    from pkg_resources.extern.packaging.utils import canonicalize_name
+
+from fades.helpers import is_hardlinked, read_name_version
+
+logger = logging.getLogger(__name__)
+
+
+def _read_record(record_path):
+    """Return the files of an installed package with their hashes (if any).
+
+    Only the files that are inside the site-packages directory are included.
+    """
+    files = {}
+    with open(record_path, 'rt', encoding='utf8', newline='') as fh:
+        for row in csv.reader(fh):
+            if not row:
+                continue
+            path = os.path.normpath(row[0])
+            if path.startswith(os.pardir) or os.path.isabs(path):
+                continue
+            files[path] = row[1] if len(row) > 1 else ''
+    return files
+
+
+def prune(basedir):
+    """Remove the packages of the store (of all the interpreters) not used by any venv.
+
+    A package is not used anymore when none of its files is hardlinked from a venv.
+    """
+    for entry_path in glob.glob(os.path.join(basedir, "packages", "*", "*")):
+        if is_hardlinked(entry_path):
+            continue
+        logger.debug("Removing package from the store: %r", entry_path)
+        # moved out first, so it's never found partially removed
+        trash_path = "{}-{}".format(entry_path, uuid4())
+        try:
+            os.rename(entry_path, trash_path)
+        except OSError:
+            continue
+        shutil.rmtree(trash_path, ignore_errors=True)
+
+
+class PackagesStore:
+    """The store of installed packages."""
+
+    def __init__(self, basedir):
+        self.store_path = os.path.join(
+            basedir, "packages", "python%d.%d" % sys.version_info[:2])
+
+    def _add(self, entry_path, site_packages, files):
+        """Add a package to the store, hardlinking the files installed in a venv."""
+        logger.debug("Adding package to the store: %r", entry_path)
+        build_path = "{}-{}".format(entry_path, uuid4())
+        try:
+            for path in files:
+                venv_file = os.path.join(site_packages, path)
+                if not os.path.exists(venv_file):
+                    # listed but not really there (e.g. a not compiled file)
+                    continue
+                store_file = os.path.join(build_path, path)
+                os.makedirs(os.path.dirname(store_file), exist_ok=True)
+                os.link(venv_file, store_file)
+        except OSError as error:
+            # probably the store is in other filesystem than the venv, nothing to share
+            logger.debug("Couldn't add the package to the store: %s", error)
+            shutil.rmtree(build_path, ignore_errors=True)
+            return
+
+        try:
+            os.rename(build_path, entry_path)
+        except OSError:
+            logger.debug("Package added to the store meanwhile, using that one")
+            shutil.rmtree(build_path)
+
+    def _link(self, entry_path, site_packages, files, record_path):
+        """Replace the files installed in a venv with hardlinks to the ones in the store."""
+        try:
+            store_files = _read_record(os.path.join(entry_path, record_path))
+        except OSError as error:
+            # removed from the store meanwhile
+            logger.debug("Couldn't read the package from the store: %s", error)
+            return
+        linked = 0
+        for path, file_hash in files.items():
+            if path not in store_files:
+                continue
+            if file_hash:
+                if file_hash != store_files[path]:
+                    continue
+            elif '__pycache__' not in path:
+                # without hash only the compiled files are linked, as their sources are
+                continue
+
+            venv_file = os.path.join(site_packages, path)
+            store_file = os.path.join(entry_path, path)
+            try:
+                if os.path.samefile(venv_file, store_file):
+                    continue
+                tmp_file = "{}.{}".format(venv_file, uuid4())
+                os.link(store_file, tmp_file)
+                os.replace(tmp_file, venv_file)
+            except OSError as error:
+                logger.debug("Couldn't link %r to the store: %s", path, error)
+                continue
+            linked += 1
+        logger.debug("Linked %d files to the store from %r", linked, entry_path)
+
+    def share(self, site_packages):
+        """Share all the packages installed in the site-packages through the store."""
+        for dist_info in glob.glob(os.path.join(site_packages, "*.dist-info")):
+            try:
+                name, version = read_name_version(os.path.join(dist_info, "METADATA"))
+                record_path = os.path.relpath(os.path.join(dist_info, "RECORD"), site_packages)
+                files = _read_record(os.path.join(site_packages, record_path))
+            except OSError as error:
+                logger.debug("Ignoring package %r, can't read it: %s", dist_info, error)
+                continue
+            if name is None or version is None:
+                logger.debug("Ignoring package %r, no name or version", dist_info)
+                continue
+
+            entry_path = os.path.join(
+                self.store_path, "{}-{}".format(canonicalize_name(name), version))
+            if os.path.exists(entry_path):
+                self._link(entry_path, site_packages, files, record_path)
+            else:
+                self._add(entry_path, site_packages, files)
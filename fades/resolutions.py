@@ -0,0 +1,135 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General
+# Public License version 3, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""A cache of the versions that pip resolved for the requirements.
+
+A requirement like 'foo >= 2' makes pip ask the packages index which is the
+newest version that matches; that version is remembered (for the
+interpreter being used) for some time, and in the meanwhile the requirement
+is installed pinned to it, without asking the index again.
+"""
+
+import json
+import logging
+import sys
+import time
+
+try:
+    from packaging.requirements import Requirement
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # way slower to import, but always there with setuptools
+    from pkg_resources.extern.packaging.requirements import Requirement
+    from pkg_resources.extern.packaging.utils import canonicalize_name
+
+from fades.helpers import atomic_write, locked
+
+logger = logging.getLogger(__name__)
+
+# how long the resolutions are used, in seconds
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def _get_interpreter():
+    """Return what identifies the interpreter, as the versions available may depend on it."""
+    return "{}{}.{}".format(sys.implementation.name, *sys.version_info[:2])
+
+
+def _get_key(requirement):
+    """Return the key of the requirement's resolution, same for equivalent requirements."""
+    specs = ",".join(sorted(str(spec) for spec in requirement.specifier))
+    extras = ",".join(sorted(requirement.extras))
+    marker = "" if requirement.marker is None else ";" + str(requirement.marker)
+    return "{} {}[{}]{}{}".format(
+        _get_interpreter(), canonicalize_name(requirement.name), extras, specs, marker)
+
+
+def is_loose(requirement):
+    """Tell if pip needs to resolve which version to install for the requirement."""
+    return not any(spec.operator in ('==', '===') for spec in requirement.specifier)
+
+
+def _pin(requirement, version):
+    """Return the requirement pinned to the version."""
+    pinned = requirement.name
+    if requirement.extras:
+        pinned += "[{}]".format(",".join(sorted(requirement.extras)))
+    pinned += "=={}".format(version)
+    if requirement.marker is not None:
+        pinned += "; {}".format(requirement.marker)
+    return Requirement(pinned)
+
+
+class ResolutionsCache:
+    """The resolutions, kept in a JSON file."""
+
+    def __init__(self, filepath, ttl=DEFAULT_TTL):
+        self.filepath = filepath
+        self.ttl = ttl
+
+    def _load(self):
+        """Return all the resolutions stored."""
+        try:
+            with open(self.filepath, 'rt', encoding='utf8') as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring broken resolutions cache %r", self.filepath)
+            return {}
+
+    def pin(self, requirements):
+        """Return the requirements, pinned to their resolved versions when known."""
+        if not self.ttl:
+            return list(requirements)
+        resolutions = self._load()
+        now = time.time()
+        pinned = []
+        for requirement in requirements:
+            resolution = resolutions.get(_get_key(requirement))
+            if resolution is None or now - resolution['timestamp'] > self.ttl:
+                pinned.append(requirement)
+            elif not requirement.specifier.contains(resolution['version'], prereleases=True):
+                # a weird version, better that pip resolves it
+                pinned.append(requirement)
+            else:
+                logger.debug("Using resolved version for %r: %s",
+                             str(requirement), resolution['version'])
+                pinned.append(_pin(requirement, resolution['version']))
+        return pinned
+
+    def store(self, requirements, versions):
+        """Store the versions installed for the requirements (the ones not pinned already).
+
+        The versions are keyed by the requirements' project name.
+        """
+        now = time.time()
+        new = {}
+        for requirement in requirements:
+            if not is_loose(requirement):
+                # nothing to resolve
+                continue
+            version = versions.get(requirement.name)
+            if version is not None:
+                new[_get_key(requirement)] = {'version': version, 'timestamp': now}
+        if not new:
+            return
+
+        with locked(self.filepath + '.lock'):
+            resolutions = self._load()
+            resolutions.update(new)
+            atomic_write(self.filepath, json.dumps(resolutions))
@@ -0,0 +1,67 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General
+# Public License version 3, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Measure how long takes each phase of what fades does."""
+
+import contextlib
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# when fades started (close enough), all the spans are relative to this
+_start = time.perf_counter()
+
+# the spans measured so far: (name, start, duration)
+_spans = []
+
+
+@contextlib.contextmanager
+def span(name):
+    """Measure what is done in this context, recording it with that name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _spans.append((name, start - _start, time.perf_counter() - start))
+
+
+def get_report():
+    """Return the spans measured so far, and the total time since start."""
+    return {
+        'total': time.perf_counter() - _start,
+        'spans': [{'name': name, 'start': start, 'duration': duration}
+                  for name, start, duration in _spans],
+    }
+
+
+def report(filepath=None):
+    """Log a summary of the spans measured so far, and write them in the file if given."""
+    data = get_report()
+    logger.debug("Timing of the different phases (start and duration):")
+    for item in data['spans']:
+        logger.debug("    %8.2f ms  %8.2f ms  %s",
+                     item['start'] * 1000, item['duration'] * 1000, item['name'])
+    logger.debug("    total: %.2f ms", data['total'] * 1000)
+
+    if filepath is not None:
+        try:
+            with open(filepath, 'wt', encoding='utf8') as fh:
+                json.dump(data, fh, indent=2)
+        except OSError as error:
+            logger.warning("Couldn't write the timing report to %r: %s", filepath, error)
@@ -22,7 +22,7 @@ Needed packages to run (using Debian/Ubuntu package names):
 
     python3.4
     python3-xdg   (optional)
-    python3-pkg-resources
+    python3-packaging   (or python3-pkg-resources, slower)
 """
 
 import os
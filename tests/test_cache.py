@@ -20,19 +20,29 @@ import json
 import logging
 import logging.handlers
 import os
+import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 from unittest.mock import patch
 
-from pkg_resources import parse_requirements
+from packaging.requirements import Requirement
 
 from fades import cache
 
 
 def get_req(text):
-    """Transform a text requirement into the pkg_resources object."""
-    return list(parse_requirements(text))
+    """Transform a text requirement (or several) into a list of packaging objects."""
+    if isinstance(text, str):
+        text = [text]
+    return [Requirement(item) for item in text]
+
+
+def get_metadata(name):
+    """Return the metadata of a (fake) venv."""
+    return {'env_path': name, 'env_bin_path': os.path.join(name, 'bin')}
 
 
 class SetupLogChecker(logging.handlers.MemoryHandler):
@@ -67,21 +77,26 @@ class TempfileTestCase(unittest.TestCase):
     """Basic functionality tests."""
 
     def setUp(self):
-        _, self.tempfile = tempfile.mkstemp(prefix="test-temp-file")
-        self.addCleanup(lambda: os.path.exists(self.tempfile) and os.remove(self.tempfile))
+        # the index alone in the base directory, as the collection looks around it
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.tempfile = os.path.join(self.tempdir, 'venvs.idx')
+        open(self.tempfile, 'wb').close()
         SetupLogChecker(self, 'fades.cache')
 
 
 class GetTestCase(TempfileTestCase):
     """A shallow 'get'."""
 
+    reqs = {'pypi': get_req('dep == 5')}
+
     def test_missing_file(self):
         os.remove(self.tempfile)
         venvscache = cache.VEnvsCache(self.tempfile)
         with patch.object(venvscache, '_select') as mock:
             mock.return_value = None
-            resp = venvscache.get_venv('requirements')
-        mock.assert_called_with([], 'requirements')
+            resp = venvscache.get_venv(self.reqs)
+        mock.assert_called_with([], self.reqs)
         self.assertEqual(resp, None)
 
     def test_empty_file(self):
@@ -89,20 +104,40 @@ class GetTestCase(TempfileTestCase):
         venvscache = cache.VEnvsCache(self.tempfile)
         with patch.object(venvscache, '_select') as mock:
             mock.return_value = None
-            resp = venvscache.get_venv('requirements')
-        mock.assert_called_with([], 'requirements')
+            resp = venvscache.get_venv(self.reqs)
+        mock.assert_called_with([], self.reqs)
         self.assertEqual(resp, None)
 
     def test_some_file_content(self):
         with open(self.tempfile, 'wt', encoding='utf8') as fh:
-            fh.write('foo\nbar\n')
+            fh.write('foo "dep"\nbar "dep"\n')
         venvscache = cache.VEnvsCache(self.tempfile)
         with patch.object(venvscache, '_select') as mock:
             mock.return_value = 'resp'
-            resp = venvscache.get_venv('requirements')
-        mock.assert_called_with(['foo', 'bar'], 'requirements')
+            resp = venvscache.get_venv(self.reqs)
+        mock.assert_called_with(['foo "dep"', 'bar "dep"'], self.reqs)
         self.assertEqual(resp, 'resp')
 
+    def test_only_candidates(self):
+        with open(self.tempfile, 'wt', encoding='utf8') as fh:
+            fh.write('{"dep1": 1, "dep-2": 2}\n')
+            fh.write('{"dep1": 1, "dep2": 2}\n')
+            fh.write('{"Dep_2": 2, "DEP1": 1}\n')
+            fh.write('{"dep12": 1, "dep-2": 2}\n')
+        venvscache = cache.VEnvsCache(self.tempfile)
+        reqs = {'pypi': get_req(['dep1', 'dep-2'])}
+        with patch.object(venvscache, '_select') as mock:
+            venvscache.get_venv(reqs)
+        mock.assert_called_with(['{"dep1": 1, "dep-2": 2}', '{"Dep_2": 2, "DEP1": 1}'], reqs)
+
+    def test_no_requirements_all_candidates(self):
+        with open(self.tempfile, 'wt', encoding='utf8') as fh:
+            fh.write('foo\nbar\n')
+        venvscache = cache.VEnvsCache(self.tempfile)
+        with patch.object(venvscache, '_select') as mock:
+            venvscache.get_venv({})
+        mock.assert_called_with(['foo', 'bar'], {})
+
 
 class StoreTestCase(TempfileTestCase):
     """Store what received."""
@@ -134,6 +169,108 @@ class StoreTestCase(TempfileTestCase):
             self.assertEqual(data['metadata'], 'metadata')
 
 
+class FingerprintTestCase(TempfileTestCase):
+    """The secondary index, keyed by requirements fingerprint."""
+
+    def test_same_reqs_same_fingerprint(self):
+        fpr1 = cache.get_fingerprint({'pypi': get_req(['dep1 >= 2, < 3', 'dep2'])})
+        fpr2 = cache.get_fingerprint({'pypi': get_req(['Dep2', 'dep1 < 3, >= 2'])})
+        self.assertEqual(fpr1, fpr2)
+
+    def test_different_reqs_different_fingerprint(self):
+        fpr1 = cache.get_fingerprint({'pypi': get_req(['dep1 >= 2'])})
+        fpr2 = cache.get_fingerprint({'pypi': get_req(['dep1 > 2'])})
+        self.assertNotEqual(fpr1, fpr2)
+
+    def test_different_repo_different_fingerprint(self):
+        fpr1 = cache.get_fingerprint({'pypi': get_req(['dep1'])})
+        fpr2 = cache.get_fingerprint({'other': get_req(['dep1'])})
+        self.assertNotEqual(fpr1, fpr2)
+
+    def test_store_and_get_without_scanning(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        venvscache = cache.VEnvsCache(self.tempfile)
+        venvscache.store({'pypi': {'dep': '7'}}, get_metadata('foobar'), reqs)
+        with patch.object(venvscache, '_select') as mock:
+            resp = venvscache.get_venv(reqs)
+        self.assertFalse(mock.called)
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_store_without_requirements(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        venvscache = cache.VEnvsCache(self.tempfile)
+        venvscache.store({'pypi': {'dep': '7'}}, get_metadata('foobar'))
+        self.assertFalse(os.path.exists(self.tempfile + '.fpr'))
+
+        # still found, but through the main index
+        with patch.object(venvscache, '_select', wraps=venvscache._select) as mock:
+            resp = venvscache.get_venv(reqs)
+        self.assertTrue(mock.called)
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_miss_falls_back_to_scan(self):
+        venvscache = cache.VEnvsCache(self.tempfile)
+        venvscache.store({'pypi': {'dep': '7'}}, get_metadata('foobar'),
+                         {'pypi': get_req('dep >= 5')})
+        resp = venvscache.get_venv({'pypi': get_req('dep > 6')})
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_broken_entry(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        os.makedirs(self.tempfile + '.fpr')
+        fpr_file = os.path.join(self.tempfile + '.fpr', cache.get_fingerprint(reqs))
+        with open(fpr_file, 'wt', encoding='utf8') as fh:
+            fh.write('{"broken')
+        venvscache = cache.VEnvsCache(self.tempfile)
+        resp = venvscache.get_venv(reqs)
+        self.assertEqual(resp, None)
+        self.assertLogged(logging.WARNING, "Ignoring broken fingerprint index entry")
+
+    def test_entry_not_a_venv(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        venvscache = cache.VEnvsCache(self.tempfile)
+        venvscache.store({'pypi': {'dep': '7'}}, get_metadata('foobar'), reqs)
+        fpr_file = os.path.join(self.tempfile + '.fpr', cache.get_fingerprint(reqs))
+        for content in ('{}', '[]', '{"metadata": {}, "installed": {}}'):
+            with open(fpr_file, 'wt', encoding='utf8') as fh:
+                fh.write(content)
+            # found scanning the main index
+            self.assertEqual(venvscache.get_venv(reqs), get_metadata('foobar'))
+        self.assertLogged(logging.WARNING, "Ignoring broken fingerprint index entry")
+
+
+class LockTestCase(TempfileTestCase):
+    """The lock on requirements."""
+
+    def test_lock_per_fingerprint(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        venvscache = cache.VEnvsCache(self.tempfile)
+        with patch.object(cache, 'locked', wraps=cache.locked) as mock:
+            with venvscache.lock(reqs):
+                pass
+        lock_path = os.path.join(self.tempfile + '.locks', cache.get_fingerprint(reqs))
+        mock.assert_called_with(lock_path)
+        self.assertTrue(os.path.exists(lock_path))
+
+    def test_waiting_process_reuses(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        venvscache1 = cache.VEnvsCache(self.tempfile)
+        venvscache2 = cache.VEnvsCache(self.tempfile)
+        found = []
+
+        def other_process():
+            with venvscache2.lock(reqs):
+                found.append(venvscache2.get_venv(reqs))
+
+        with venvscache1.lock(reqs):
+            thread = threading.Thread(target=other_process)
+            thread.start()
+            self.assertEqual(venvscache1.get_venv(reqs), None)
+            venvscache1.store({'pypi': {'dep': '7'}}, get_metadata('foobar'), reqs)
+        thread.join()
+        self.assertEqual(found, [get_metadata('foobar')])
+
+
 class SelectionTestCase(TempfileTestCase):
     """The venv selection."""
 
@@ -148,7 +285,7 @@ class SelectionTestCase(TempfileTestCase):
     def test_nomatch_repo(self):
         reqs = {'repoloco': get_req('dep == 5')}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep': '5'}},
         })
         resp = self.venvscache._select([venv], reqs)
@@ -157,7 +294,7 @@ class SelectionTestCase(TempfileTestCase):
     def test_nomatch_dependency(self):
         reqs = {'pypi': get_req('dep1 == 5')}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep2': '5'}},
         })
         resp = self.venvscache._select([venv], reqs)
@@ -166,7 +303,7 @@ class SelectionTestCase(TempfileTestCase):
     def test_nomatch_version(self):
         reqs = {'pypi': get_req('dep == 5')}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep': '7'}},
         })
         resp = self.venvscache._select([venv], reqs)
@@ -175,51 +312,51 @@ class SelectionTestCase(TempfileTestCase):
     def test_simple_match(self):
         reqs = {'pypi': get_req('dep == 5')}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep': '5'}},
         })
         resp = self.venvscache._select([venv], reqs)
-        self.assertEqual(resp, 'foobar')
+        self.assertEqual(resp, get_metadata('foobar'))
 
     def test_match_noversion(self):
         reqs = {'pypi': get_req('dep')}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep': '5'}},
         })
         resp = self.venvscache._select([venv], reqs)
-        self.assertEqual(resp, 'foobar')
+        self.assertEqual(resp, get_metadata('foobar'))
 
     def test_middle_match(self):
         reqs = {'pypi': get_req('dep == 5')}
         venv1 = json.dumps({
-            'metadata': 'venv1',
+            'metadata': get_metadata('venv1'),
             'installed': {'pypi': {'dep': '3'}},
         })
         venv2 = json.dumps({
-            'metadata': 'venv2',
+            'metadata': get_metadata('venv2'),
             'installed': {'pypi': {'dep': '5'}},
         })
         venv3 = json.dumps({
-            'metadata': 'venv3',
+            'metadata': get_metadata('venv3'),
             'installed': {'pypi': {'dep': '5'}},
         })
         resp = self.venvscache._select([venv1, venv2, venv3], reqs)
-        self.assertEqual(resp, 'venv2')
+        self.assertEqual(resp, get_metadata('venv2'))
 
     def test_multiple_deps_ok(self):
         reqs = {'pypi': get_req(['dep1 == 5', 'dep2 == 7'])}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep1': '5', 'dep2': '7'}},
         })
         resp = self.venvscache._select([venv], reqs)
-        self.assertEqual(resp, 'foobar')
+        self.assertEqual(resp, get_metadata('foobar'))
 
     def test_multiple_deps_just_one(self):
         reqs = {'pypi': get_req(['dep1 == 5', 'dep2 == 7'])}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep1': '5', 'dep2': '2'}},
         })
         resp = self.venvscache._select([venv], reqs)
@@ -228,7 +365,7 @@ class SelectionTestCase(TempfileTestCase):
     def test_not_too_crowded(self):
         reqs = {'pypi': get_req(['dep1'])}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep1': '5', 'dep2': '2'}},
         })
         resp = self.venvscache._select([venv], reqs)
@@ -237,13 +374,333 @@ class SelectionTestCase(TempfileTestCase):
     def test_same_quantity_different_deps(self):
         reqs = {'pypi': get_req(['dep1', 'dep2'])}
         venv = json.dumps({
-            'metadata': 'foobar',
+            'metadata': get_metadata('foobar'),
             'installed': {'pypi': {'dep1': '5', 'dep3': '2'}},
         })
         resp = self.venvscache._select([venv], reqs)
         self.assertEqual(resp, None)
 
 
+class PrebuiltEntriesTestCase(TempfileTestCase):
+    """The index entries are built only once per process."""
+
+    def setUp(self):
+        super().setUp()
+        self.venvscache = cache.VEnvsCache(self.tempfile)
+
+    def test_built_once(self):
+        venv = json.dumps({
+            'metadata': get_metadata('foobar'),
+            'installed': {'pypi': {'dep': '5'}},
+        })
+        self.venvscache._select([venv], {'pypi': get_req('dep == 3')})
+        with patch.object(self.venvscache, '_build_installed') as mock:
+            resp = self.venvscache._select([venv], {'pypi': get_req('dep == 5')})
+        self.assertFalse(mock.called)
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_forgotten_when_index_replaced(self):
+        self.venvscache.store({'pypi': {'dep': '5'}}, get_metadata('venv1'))
+        self.venvscache.get_venv({'pypi': get_req('dep == 5')})
+        self.assertEqual(len(self.venvscache._entries), 1)
+
+        # appended lines don't make the built entries invalid
+        self.venvscache.store({'pypi': {'dep': '6'}}, get_metadata('venv2'))
+        self.venvscache.get_venv({'pypi': get_req('dep == 7')})
+        self.assertEqual(len(self.venvscache._entries), 2)
+
+        # but when the index is rewritten they may be
+        self.venvscache._remove({'venv1'})
+        self.venvscache.get_venv({'pypi': get_req('dep == 7')})
+        self.assertEqual([venv['metadata'] for _, venv in self.venvscache._entries.values()],
+                         [get_metadata('venv2')])
+
+    def test_project_case_insensitive(self):
+        venv = json.dumps({
+            'metadata': get_metadata('foobar'),
+            'installed': {'pypi': {'Dep': '5'}},
+        })
+        resp = self.venvscache._select([venv], {'pypi': get_req('dep == 5')})
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_installed_package(self):
+        pkg = cache.InstalledPackage('Foo', '2.1')
+        self.assertEqual(pkg.key, 'foo')
+        self.assertTrue(pkg.satisfies(get_req('foo > 2')[0]))
+        self.assertFalse(pkg.satisfies(get_req('foo > 3')[0]))
+
+
+class ExtendTestCase(TempfileTestCase):
+    """The search of a venv to extend."""
+
+    def setUp(self):
+        super().setUp()
+        self.venvscache = cache.VEnvsCache(self.tempfile)
+
+    def test_empty(self):
+        resp = self.venvscache.get_venv_to_extend({'pypi': get_req('dep1')})
+        self.assertEqual(resp, None)
+
+    def test_subset(self):
+        self.venvscache.store({'pypi': {'dep1': '5'}}, get_metadata('foobar'))
+        reqs = {'pypi': get_req(['dep1 >= 3', 'dep2'])}
+        resp = self.venvscache.get_venv_to_extend(reqs)
+        self.assertEqual(resp, (get_metadata('foobar'), {'pypi': {'dep1': '5'}},
+                                {'pypi': [reqs['pypi'][1]]}))
+
+    def test_largest_subset(self):
+        self.venvscache.store({'pypi': {'dep1': '5'}}, get_metadata('venv1'))
+        self.venvscache.store({'pypi': {'dep1': '5', 'dep2': '2'}}, get_metadata('venv2'))
+        self.venvscache.store({'pypi': {'dep3': '1'}}, get_metadata('venv3'))
+        reqs = {'pypi': get_req(['dep1', 'dep2', 'dep3', 'dep4'])}
+        metadata, _, missing = self.venvscache.get_venv_to_extend(reqs)
+        self.assertEqual(metadata, get_metadata('venv2'))
+        self.assertEqual(missing, {'pypi': get_req(['dep3', 'dep4'])})
+
+    def test_extra_stuff_installed(self):
+        self.venvscache.store({'pypi': {'dep1': '5', 'dep9': '2'}}, get_metadata('foobar'))
+        resp = self.venvscache.get_venv_to_extend({'pypi': get_req(['dep1', 'dep2'])})
+        self.assertEqual(resp, None)
+
+    def test_extra_repo_installed(self):
+        self.venvscache.store({'pypi': {'dep1': '5'}, 'other': {'dep1': '5'}},
+                              get_metadata('foobar'))
+        resp = self.venvscache.get_venv_to_extend({'pypi': get_req(['dep1', 'dep2'])})
+        self.assertEqual(resp, None)
+
+    def test_version_not_satisfied(self):
+        self.venvscache.store({'pypi': {'dep1': '5'}}, get_metadata('foobar'))
+        resp = self.venvscache.get_venv_to_extend({'pypi': get_req(['dep1 > 5', 'dep2'])})
+        self.assertEqual(resp, None)
+
+    def test_sqlite(self):
+        os.remove(self.tempfile)
+        venvscache = cache.SQLiteVEnvsCache(self.tempfile)
+        self.addCleanup(venvscache.conn.close)
+        venvscache.store({'pypi': {'dep1': '5'}}, get_metadata('venv1'))
+        venvscache.store({'pypi': {'dep1': '5', 'dep2': '2'}}, get_metadata('venv2'))
+        reqs = {'pypi': get_req(['dep1', 'dep2', 'dep3'])}
+        resp = venvscache.get_venv_to_extend(reqs)
+        self.assertEqual(resp, (get_metadata('venv2'), {'pypi': {'dep1': '5', 'dep2': '2'}},
+                                {'pypi': get_req(['dep3'])}))
+
+
+class CollectTestCase(TempfileTestCase):
+    """The eviction of venvs."""
+
+    def setUp(self):
+        super().setUp()
+        self.venvscache = cache.VEnvsCache(self.tempfile)
+
+    def store_venv(self, name, last_use, size=0, reqs=None):
+        """Create a fake venv and store it."""
+        env_path = os.path.join(self.tempdir, name)
+        os.mkdir(env_path)
+        with open(os.path.join(env_path, 'somefile'), 'wb') as fh:
+            fh.write(b'x' * size)
+        os.utime(env_path, (last_use, last_use))
+        self.venvscache.store({'pypi': {name: '1'}}, get_metadata(env_path), reqs)
+        return env_path
+
+    def get_stored(self):
+        """Return the env paths of all that is stored in the index."""
+        return [venv['metadata']['env_path'] for _, venv in self.venvscache._iter_entries()]
+
+    def test_mark_used(self):
+        env_path = self.store_venv('venv1', 1000)
+        self.venvscache.mark_used({'env_path': env_path})
+        self.assertGreater(os.stat(env_path).st_mtime, 1000)
+
+    def test_no_limits(self):
+        env_path = self.store_venv('venv1', 1000)
+        evicted = self.venvscache.collect()
+        self.assertEqual(evicted, set())
+        self.assertEqual(self.get_stored(), [env_path])
+
+    def test_dead_venvs(self):
+        env_path1 = self.store_venv('venv1', 1000)
+        env_path2 = self.store_venv('venv2', 1000)
+        shutil.rmtree(env_path1)
+        evicted = self.venvscache.collect()
+        self.assertEqual(evicted, {env_path1})
+        self.assertEqual(self.get_stored(), [env_path2])
+
+    def test_max_age(self):
+        now = time.time()
+        env_path1 = self.store_venv('venv1', now - 1000)
+        env_path2 = self.store_venv('venv2', now - 10)
+        evicted = self.venvscache.collect(max_age=100)
+        self.assertEqual(evicted, {env_path1})
+        self.assertFalse(os.path.exists(env_path1))
+        self.assertEqual(self.get_stored(), [env_path2])
+
+    def test_max_count(self):
+        env_path1 = self.store_venv('venv1', 3000)
+        env_path2 = self.store_venv('venv2', 1000)
+        env_path3 = self.store_venv('venv3', 2000)
+        evicted = self.venvscache.collect(max_count=2)
+        self.assertEqual(evicted, {env_path2})
+        self.assertEqual(self.get_stored(), [env_path1, env_path3])
+
+    def test_max_size(self):
+        env_path1 = self.store_venv('venv1', 3000, size=100)
+        env_path2 = self.store_venv('venv2', 1000, size=100)
+        env_path3 = self.store_venv('venv3', 2000, size=100)
+        evicted = self.venvscache.collect(max_size=250)
+        self.assertEqual(evicted, {env_path2})
+        self.assertEqual(self.get_stored(), [env_path1, env_path3])
+
+    def test_max_size_shared_files(self):
+        shared = os.path.join(self.tempdir, 'shared')
+        with open(shared, 'wb') as fh:
+            fh.write(b'x' * 100)
+        env_paths = []
+        for i, last_use in enumerate((3000, 1000, 2000)):
+            env_path = self.store_venv('venv{}'.format(i), last_use, size=10)
+            os.link(shared, os.path.join(env_path, 'shared'))
+            os.utime(env_path, (last_use, last_use))
+            env_paths.append(env_path)
+
+        # the shared file is counted only once: 100 + 3 * 10
+        evicted = self.venvscache.collect(max_size=130)
+        self.assertEqual(evicted, set())
+        evicted = self.venvscache.collect(max_size=129)
+        self.assertEqual(evicted, {env_paths[1]})
+
+    def test_fingerprint_index_cleaned(self):
+        reqs1 = {'pypi': get_req('dep1')}
+        reqs2 = {'pypi': get_req('dep2')}
+        self.store_venv('venv1', 1000, reqs=reqs1)
+        env_path2 = self.store_venv('venv2', 2000, reqs=reqs2)
+        self.venvscache.collect(max_count=1)
+        self.assertEqual(self.venvscache._get_by_fingerprint(reqs1), None)
+        self.assertEqual(self.venvscache._get_by_fingerprint(reqs2), get_metadata(env_path2))
+
+    def test_shared_files_freed(self):
+        env_path = self.store_venv('venv1', 1000)
+        entry_path = os.path.join(self.tempdir, 'packages', 'python3.4', 'dep-1')
+        os.makedirs(entry_path)
+        os.link(os.path.join(env_path, 'somefile'), os.path.join(entry_path, 'somefile'))
+
+        self.venvscache.collect(max_count=1)
+        self.assertTrue(os.path.exists(entry_path))
+        self.venvscache.collect(max_count=0)
+        self.assertFalse(os.path.exists(entry_path))
+
+    def test_locks_removed(self):
+        reqs1 = {'pypi': get_req('dep1')}
+        reqs2 = {'pypi': get_req('dep2')}
+        with self.venvscache.lock(reqs1):
+            pass
+        with self.venvscache.lock(reqs2):
+            self.venvscache.store({'pypi': {'dep2': '1'}}, get_metadata('venv2'), reqs2)
+            self.venvscache.collect()
+        # the one held and the index's are kept
+        self.assertEqual(sorted(os.listdir(self.venvscache.lockspath)),
+                         sorted([cache.get_fingerprint(reqs2), 'index']))
+
+    def test_sqlite(self):
+        os.remove(self.tempfile)
+        self.venvscache = cache.SQLiteVEnvsCache(self.tempfile)
+        self.addCleanup(self.venvscache.conn.close)
+        self.store_venv('venv1', 1000)
+        env_path2 = self.store_venv('venv2', 2000)
+        self.venvscache.collect(max_count=1)
+        self.assertEqual(self.get_stored(), [env_path2])
+        cursor = self.venvscache.conn.execute("SELECT COUNT(*) FROM installed")
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class CompactTestCase(TempfileTestCase):
+    """The index compaction and broken lines handling."""
+
+    def setUp(self):
+        super().setUp()
+        self.venvscache = cache.VEnvsCache(self.tempfile)
+
+    def make_venv(self, name, with_python=True):
+        """Create a fake venv, return its metadata."""
+        env_path = os.path.join(self.tempdir, name)
+        env_bin_path = os.path.join(env_path, 'bin')
+        os.makedirs(env_bin_path)
+        if with_python:
+            open(os.path.join(env_bin_path, 'python3'), 'wb').close()
+        return {'env_path': env_path, 'env_bin_path': env_bin_path}
+
+    def read_index(self):
+        """Return the metadata of all that is in the index file."""
+        with open(self.tempfile, 'rt', encoding='utf8') as fh:
+            return [json.loads(line)['metadata'] for line in fh]
+
+    def test_broken_lines_skipped(self):
+        with open(self.tempfile, 'wt', encoding='utf8') as fh:
+            fh.write('{"dep": "5", "truncated\n')
+            fh.write('{"foo": "dep"}\n')
+            fh.write(json.dumps({'metadata': get_metadata('foobar'),
+                                 'installed': {'pypi': {'dep': '5'}}}))
+        resp = self.venvscache.get_venv({'pypi': get_req('dep == 5')})
+        self.assertEqual(resp, get_metadata('foobar'))
+        self.assertLogged(logging.WARNING, "Ignoring broken line in the index", "truncated")
+        self.assertLogged(logging.WARNING, "Ignoring broken line in the index", "foo")
+
+    def test_entries_without_venv_paths_skipped(self):
+        alive = self.make_venv('alive')
+        with open(self.tempfile, 'wt', encoding='utf8') as fh:
+            fh.write('{"installed": {}, "metadata": {}}\n')
+            fh.write('{"installed": {}, "metadata": "dep"}\n')
+            fh.write('{"installed": [], "metadata": {"env_path": "x", "env_bin_path": "y"}}\n')
+        self.venvscache.store({'pypi': {'dep': '5'}}, alive)
+
+        # neither the collection nor the compaction crash
+        self.assertEqual(self.venvscache.collect(), set())
+        self.venvscache.compact()
+        self.assertEqual(self.read_index(), [alive])
+        self.assertLogged(logging.WARNING, "Ignoring broken line in the index", "{}")
+
+    def test_compact(self):
+        alive = self.make_venv('alive')
+        no_dir = self.make_venv('nodir')
+        shutil.rmtree(no_dir['env_path'])
+        no_python = self.make_venv('nopython', with_python=False)
+        with open(self.tempfile, 'wt', encoding='utf8') as fh:
+            fh.write('{"truncated\n')
+        self.venvscache.store({'pypi': {'dep': '5'}}, no_dir)
+        self.venvscache.store({'pypi': {'dep': '5'}}, alive)
+        self.venvscache.store({'pypi': {'dep': '5'}}, no_python)
+        self.venvscache.store({'pypi': {'dep': '6'}}, alive)
+
+        self.venvscache.compact()
+        self.assertEqual(self.read_index(), [alive])
+
+    def test_compact_fingerprint_index(self):
+        alive = self.make_venv('alive')
+        dead = self.make_venv('dead')
+        reqs_alive = {'pypi': get_req('dep1')}
+        reqs_dead = {'pypi': get_req('dep2')}
+        self.venvscache.store({'pypi': {'dep1': '5'}}, alive, reqs_alive)
+        self.venvscache.store({'pypi': {'dep2': '5'}}, dead, reqs_dead)
+        shutil.rmtree(dead['env_path'])
+
+        self.venvscache.compact()
+        self.assertEqual(self.venvscache._get_by_fingerprint(reqs_alive), alive)
+        self.assertEqual(self.venvscache._get_by_fingerprint(reqs_dead), None)
+        self.assertEqual(len(os.listdir(self.tempfile + '.fpr')), 1)
+
+    def test_compact_sqlite(self):
+        os.remove(self.tempfile)
+        venvscache = cache.SQLiteVEnvsCache(self.tempfile)
+        self.addCleanup(venvscache.conn.close)
+        alive = self.make_venv('alive')
+        dead = self.make_venv('dead')
+        venvscache.store({'pypi': {'dep': '5'}}, dead)
+        venvscache.store({'pypi': {'dep': '5'}}, alive)
+        shutil.rmtree(dead['env_path'])
+
+        venvscache.compact()
+        stored = [venv['metadata'] for _, venv in venvscache._iter_entries()]
+        self.assertEqual(stored, [alive])
+
+
 class ComparisonsTestCase(TempfileTestCase):
     """The comparison in the selection."""
 
@@ -255,11 +712,11 @@ class ComparisonsTestCase(TempfileTestCase):
         """Check if the requirement is satisfied with what is installed."""
         reqs = {'pypi': get_req('dep' + req)}
         venv = json.dumps({
-            'metadata': 'ok',
+            'metadata': get_metadata('ok'),
             'installed': {'pypi': {'dep': installed}},
         })
         resp = self.venvscache._select([venv], reqs)
-        return resp
+        return resp and resp['env_path']
 
     def test_comp_eq(self):
         self.assertEqual(self.check('==5', '5'), 'ok')
@@ -296,3 +753,139 @@ class ComparisonsTestCase(TempfileTestCase):
         self.assertEqual(self.check('>1.6,<1.9,!=1.9.6', '1.6.7'), 'ok')
         self.assertEqual(self.check('>1.6,<1.9,!=1.8.6', '1.8.7'), 'ok')
         self.assertEqual(self.check('>1.6,<1.9,!=1.9.6', '1.9.6'), None)
+
+
+class SQLiteTestCase(TempfileTestCase):
+    """The SQLite backed index."""
+
+    def setUp(self):
+        super().setUp()
+        os.remove(self.tempfile)
+        self.venvscache = cache.SQLiteVEnvsCache(self.tempfile)
+        self.addCleanup(self.venvscache.conn.close)
+
+    def test_empty(self):
+        resp = self.venvscache.get_venv({'pypi': get_req('dep')})
+        self.assertEqual(resp, None)
+
+    def test_store_and_get(self):
+        self.venvscache.store({'pypi': {'dep': '5'}}, {'env_path': 'foobar'})
+        resp = self.venvscache.get_venv({'pypi': get_req('dep == 5')})
+        self.assertEqual(resp, {'env_path': 'foobar'})
+
+    def test_nomatch_version(self):
+        self.venvscache.store({'pypi': {'dep': '7'}}, get_metadata('foobar'))
+        resp = self.venvscache.get_venv({'pypi': get_req('dep == 5')})
+        self.assertEqual(resp, None)
+
+    def test_nomatch_repo(self):
+        self.venvscache.store({'pypi': {'dep': '5'}}, get_metadata('foobar'))
+        resp = self.venvscache.get_venv({'repoloco': get_req('dep == 5')})
+        self.assertEqual(resp, None)
+
+    def test_not_too_crowded(self):
+        self.venvscache.store({'pypi': {'dep1': '5', 'dep2': '2'}}, get_metadata('foobar'))
+        resp = self.venvscache.get_venv({'pypi': get_req(['dep1'])})
+        self.assertEqual(resp, None)
+
+    def test_middle_match(self):
+        self.venvscache.store({'pypi': {'dep': '3'}}, get_metadata('venv1'))
+        self.venvscache.store({'pypi': {'dep': '5'}}, get_metadata('venv2'))
+        self.venvscache.store({'pypi': {'dep': '5'}}, get_metadata('venv3'))
+        resp = self.venvscache.get_venv({'pypi': get_req('dep == 5')})
+        self.assertEqual(resp, get_metadata('venv2'))
+
+    def test_multiple_deps_ok(self):
+        self.venvscache.store({'pypi': {'Dep1': '5', 'dep2': '7'}}, get_metadata('foobar'))
+        resp = self.venvscache.get_venv({'pypi': get_req(['dep1 == 5', 'dep2 == 7'])})
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_candidates_filtered_by_project(self):
+        self.venvscache.store({'pypi': {'dep1': '5'}}, get_metadata('venv1'))
+        self.venvscache.store({'pypi': {'dep2': '5'}}, get_metadata('venv2'))
+        self.venvscache.store({'pypi': {'dep1': '3', 'dep2': '5'}}, get_metadata('venv3'))
+        with patch.object(self.venvscache, '_venv_match') as mock:
+            mock.return_value = False
+            self.venvscache.get_venv({'pypi': get_req(['dep2'])})
+        self.assertEqual(mock.call_count, 2)
+
+    def test_get_by_fingerprint(self):
+        reqs = {'pypi': get_req('dep >= 5')}
+        self.venvscache.store({'pypi': {'dep': '7'}}, get_metadata('foobar'), reqs)
+        with patch.object(self.venvscache, '_venv_match') as mock:
+            resp = self.venvscache.get_venv(reqs)
+        self.assertFalse(mock.called)
+        self.assertEqual(resp, get_metadata('foobar'))
+
+    def test_migration_skips_not_venvs(self):
+        _, idx_path = tempfile.mkstemp(prefix="test-temp-file")
+        self.addCleanup(os.remove, idx_path)
+        with open(idx_path, 'wt', encoding='utf8') as fh:
+            fh.write('{"installed": {}, "metadata": {}}\n')
+            fh.write(json.dumps({
+                'timestamp': 1,
+                'metadata': get_metadata('foobar'),
+                'installed': {'pypi': {'dep': '5'}},
+            }) + '\n')
+
+        venvscache = cache.SQLiteVEnvsCache(self.tempfile, migrate_from=idx_path)
+        self.addCleanup(venvscache.conn.close)
+        self.assertEqual(venvscache.get_venv({'pypi': get_req('dep == 5')}),
+                         get_metadata('foobar'))
+        self.assertLogged(logging.WARNING, "Ignoring broken line when migrating")
+        cursor = venvscache.conn.execute("SELECT COUNT(*) FROM migrations")
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_migration_concurrent(self):
+        _, idx_path = tempfile.mkstemp(prefix="test-temp-file")
+        self.addCleanup(os.remove, idx_path)
+        with open(idx_path, 'wt', encoding='utf8') as fh:
+            for i in range(100):
+                fh.write(json.dumps({
+                    'timestamp': i,
+                    'metadata': get_metadata('venv{}'.format(i)),
+                    'installed': {'pypi': {'dep': str(i)}},
+                }) + '\n')
+
+        barrier = threading.Barrier(6)
+        errors = []
+
+        def other_process():
+            barrier.wait()
+            try:
+                venvscache = cache.SQLiteVEnvsCache(self.tempfile, migrate_from=idx_path)
+                venvscache.conn.close()
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=other_process) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        cursor = self.venvscache.conn.execute("SELECT COUNT(*) FROM venvs")
+        self.assertEqual(cursor.fetchone()[0], 100)
+
+    def test_migration(self):
+        _, idx_path = tempfile.mkstemp(prefix="test-temp-file")
+        self.addCleanup(os.remove, idx_path)
+        with open(idx_path, 'wt', encoding='utf8') as fh:
+            fh.write(json.dumps({
+                'timestamp': 1,
+                'metadata': get_metadata('foobar'),
+                'installed': {'pypi': {'dep': '5'}},
+            }) + '\n')
+            fh.write('{"broken\n')
+
+        venvscache = cache.SQLiteVEnvsCache(self.tempfile, migrate_from=idx_path)
+        self.addCleanup(venvscache.conn.close)
+        resp = venvscache.get_venv({'pypi': get_req('dep == 5')})
+        self.assertEqual(resp, get_metadata('foobar'))
+        self.assertLogged(logging.WARNING, "Ignoring broken line when migrating")
+
+        # the migration is done only once
+        venvscache = cache.SQLiteVEnvsCache(self.tempfile, migrate_from=idx_path)
+        self.addCleanup(venvscache.conn.close)
+        cursor = venvscache.conn.execute("SELECT COUNT(*) FROM venvs")
+        self.assertEqual(cursor.fetchone()[0], 1)
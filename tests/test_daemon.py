@@ -0,0 +1,148 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the daemon."""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import patch
+
+from fades import daemon, parsing
+
+
+class DaemonTestCase(unittest.TestCase):
+    """Ask a running daemon."""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.basedir)
+        self.socket_path = daemon.get_socket_path(self.basedir)
+
+        self.script = os.path.join(self.basedir, 'script.py')
+        with open(self.script, 'wt', encoding='utf8') as fh:
+            fh.write("import foo    # fades.pypi\n")
+
+        self.server = daemon.FadesServer(self.socket_path, self.basedir)
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever, args=(.01,))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def make_venv(self):
+        """Create a venv dir and store it in the index for the script's requirements."""
+        metadata = {'env_path': os.path.join(self.basedir, 'venv'), 'env_bin_path': 'bin'}
+        os.mkdir(metadata['env_path'])
+        requirements = parsing.parse_file(self.script)
+        self.server.venvscache.store({'pypi': {'foo': '1.0'}}, metadata, requirements)
+        return metadata
+
+    def test_venv_found(self):
+        metadata = self.make_venv()
+        self.assertEqual(daemon.get_venv(self.socket_path, self.script), metadata)
+
+    def test_venv_not_found(self):
+        self.assertIsNone(daemon.get_venv(self.socket_path, self.script))
+
+    def test_relative_path(self):
+        metadata = self.make_venv()
+        os.chdir(self.basedir)
+        self.addCleanup(os.chdir, os.getcwd())
+        self.assertEqual(daemon.get_venv(self.socket_path, 'script.py'), metadata)
+
+    def test_parsed_only_once(self):
+        self.make_venv()
+        with patch.object(parsing, 'parse_file', wraps=parsing.parse_file) as mock:
+            daemon.get_venv(self.socket_path, self.script)
+            daemon.get_venv(self.socket_path, self.script)
+        self.assertEqual(mock.call_count, 1)
+
+    def test_parsed_again_if_changed(self):
+        daemon.get_venv(self.socket_path, self.script)
+        with open(self.script, 'at', encoding='utf8') as fh:
+            fh.write("import bar    # fades.pypi\n")
+        with patch.object(parsing, 'parse_file', wraps=parsing.parse_file) as mock:
+            daemon.get_venv(self.socket_path, self.script)
+        self.assertEqual(mock.call_count, 1)
+
+    def test_marks_used(self):
+        metadata = self.make_venv()
+        os.utime(metadata['env_path'], (0, 0))
+        daemon.get_venv(self.socket_path, self.script)
+        self.assertGreater(os.stat(metadata['env_path']).st_mtime, 0)
+
+    def test_error_in_daemon(self):
+        missing = os.path.join(self.basedir, 'missing.py')
+        with patch.object(daemon.logger, 'exception'):
+            self.assertIsNone(daemon.get_venv(self.socket_path, missing))
+
+    def test_removed_scripts_forgotten(self):
+        other = os.path.join(self.basedir, 'other.py')
+        with open(other, 'wt', encoding='utf8') as fh:
+            fh.write("import bar    # fades.pypi\n")
+        daemon.get_venv(self.socket_path, self.script)
+        daemon.get_venv(self.socket_path, other)
+        self.server.shutdown()
+        os.remove(other)
+
+        # not yet, only from time to time
+        self.server.service_actions()
+        self.assertEqual(len(self.server._parsed), 2)
+        self.server._last_prune -= daemon.PRUNE_INTERVAL
+        self.server.service_actions()
+        self.assertEqual(list(self.server._parsed), [self.script])
+
+    def test_removed_script_forgotten_when_asked(self):
+        daemon.get_venv(self.socket_path, self.script)
+        os.remove(self.script)
+        with patch.object(daemon.logger, 'exception'):
+            self.assertIsNone(daemon.get_venv(self.socket_path, self.script))
+        self.assertEqual(self.server._parsed, {})
+
+    def test_socket_removed_when_closed(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+class NoDaemonTestCase(unittest.TestCase):
+    """The daemon is not there."""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.basedir)
+        self.socket_path = daemon.get_socket_path(self.basedir)
+
+    def test_no_socket(self):
+        self.assertIsNone(daemon.get_venv(self.socket_path, 'script.py'))
+
+    def test_stale_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.close()
+        self.assertIsNone(daemon.get_venv(self.socket_path, 'script.py'))
+
+    def test_stale_socket_replaced(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.close()
+        server = daemon.FadesServer(self.socket_path, self.basedir)
+        server.server_close()
@@ -16,19 +16,23 @@
 
 """Tests for the venv builder module."""
 
+import asyncio
 import logging
+import os
+import shutil
+import tempfile
 import unittest
 
 from unittest.mock import patch
 
-from pkg_resources import parse_requirements
+from packaging.requirements import Requirement
 
-from fades import REPO_PYPI, envbuilder
+from fades import REPO_PYPI, envbuilder, pipmanager
 
 
 def get_req(text):
-    """Transform a text requirement into the pkg_resources object."""
-    return list(parse_requirements(text))[0]
+    """Transform a text requirement into the packaging object."""
+    return Requirement(text)
 
 
 class EnvCreationTestCase(unittest.TestCase):
@@ -40,11 +44,29 @@ class EnvCreationTestCase(unittest.TestCase):
             self.req_installed = []
             self.really_installed = {}
 
-        def install(self, dependency):
-            self.req_installed.append(dependency)
+            self.install_calls = 0
+            self.no_deps = None
+            self.resolve = None
 
-        def get_version(self, dependency):
-            return self.really_installed[dependency]
+        def install(self, *dependencies, no_deps=False, resolve=False):
+            self.install_calls += 1
+            self.req_installed.extend(dependencies)
+            self.no_deps = no_deps
+            self.resolve = resolve
+
+        async def async_install(self, *dependencies, resolve=False):
+            self.install(*dependencies, resolve=resolve)
+            if self.really_installed is None:
+                # takes forever
+                await asyncio.sleep(100)
+
+        def get_installed_versions(self):
+            return self.really_installed
+
+    def setUp(self):
+        patcher = patch.object(envbuilder, 'PackagesStore')
+        self.mock_store = patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_create_simple(self):
         requested = {
@@ -57,6 +79,10 @@ class EnvCreationTestCase(unittest.TestCase):
                 fake_manager.really_installed = {'dep1': 'v1', 'dep2': 'v2'}
                 venv_data, installed = envbuilder.create_venv(requested)
 
+        # all installed at once
+        self.assertEqual(fake_manager.install_calls, 1)
+        self.assertEqual(fake_manager.req_installed, requested[REPO_PYPI])
+
         self.assertEqual(venv_data, {
             'env_bin_path': 'env_bin_path',
             'env_path': 'env_path',
@@ -68,6 +94,8 @@ class EnvCreationTestCase(unittest.TestCase):
                 'dep2': 'v2',
             }
         })
+        self.mock_store.return_value.share.assert_called_with(
+            envbuilder.get_site_packages('env_path'))
 
     def test_unknown_repo(self):
         requested = {
@@ -99,3 +127,326 @@ class EnvCreationTestCase(unittest.TestCase):
                 'dep2': 'v2',
             }
         })
+
+    def test_version_not_found(self):
+        requested = {
+            REPO_PYPI: [get_req('dep1 == v1'), get_req('dep2 == v2')]
+        }
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                with self.assertLogs(level=logging.WARNING) as logcheck:
+                    mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                    mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                    fake_manager.really_installed = {'dep2': 'v2'}
+                    _, installed = envbuilder.create_venv(requested)
+
+        self.assertEqual(installed, {REPO_PYPI: {'dep2': 'v2'}})
+        self.assertEqual(logcheck.records[0].message,
+                         "Couldn't get the installed version of 'dep1'")
+
+    def test_installed_name_differs(self):
+        requested = {
+            REPO_PYPI: [get_req('Foo_Bar')]
+        }
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = {'foo-bar': '3', 'otherdep': '1'}
+                _, installed = envbuilder.create_venv(requested)
+
+        self.assertEqual(installed, {REPO_PYPI: {'Foo_Bar': '3'}})
+
+    def test_extend_base(self):
+        requested = {
+            REPO_PYPI: [get_req('dep2 == v2')]
+        }
+        base_data = {'env_path': 'base_env_path'}
+        base_installed = {REPO_PYPI: {'dep1': 'v1'}}
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = {'dep1': 'v1', 'dep2': 'v2'}
+                venv_data, installed = envbuilder.create_venv(
+                    requested, base=(base_data, base_installed))
+
+        mock_create.assert_called_with('base_env_path')
+        self.assertEqual(fake_manager.req_installed, requested[REPO_PYPI])
+        self.assertEqual(venv_data['env_path'], 'env_path')
+        self.assertEqual(installed, {REPO_PYPI: {'dep1': 'v1', 'dep2': 'v2'}})
+        # the base is not modified
+        self.assertEqual(base_installed, {REPO_PYPI: {'dep1': 'v1'}})
+
+    def test_create_with_resolutions(self):
+        requested = {
+            REPO_PYPI: [get_req('dep1 >= 1'), get_req('dep2 >= 2')]
+        }
+        pinned = [get_req('dep1 == 1.5'), requested[REPO_PYPI][1]]
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = {'dep1': '1.5', 'dep2': '2.1'}
+                with patch.object(envbuilder, 'PackagesStore'):
+                    resolutions = unittest.mock.Mock()
+                    resolutions.pin.return_value = pinned
+                    _, installed = envbuilder.create_venv(requested, resolutions=resolutions)
+
+        # installed pinned, but recorded as requested
+        self.assertEqual(fake_manager.req_installed, pinned)
+        self.assertEqual(installed, {REPO_PYPI: {'dep1': '1.5', 'dep2': '2.1'}})
+        # dep2 was not resolved before, so the index is asked
+        self.assertTrue(fake_manager.resolve)
+        # only stored what was really resolved by pip
+        resolutions.store.assert_called_once_with(
+            [requested[REPO_PYPI][1]], {'dep1': '1.5', 'dep2': '2.1'})
+
+    def test_create_all_resolved(self):
+        requested = {
+            REPO_PYPI: [get_req('dep1 >= 1'), get_req('dep2 == 2.0')]
+        }
+        pinned = [get_req('dep1 == 1.5'), requested[REPO_PYPI][1]]
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = {'dep1': '1.5', 'dep2': '2.0'}
+                resolutions = unittest.mock.Mock()
+                resolutions.pin.return_value = pinned
+                envbuilder.create_venv(requested, resolutions=resolutions)
+
+        # exact versions need no resolving, whatever the wheelhouse has is fine
+        self.assertFalse(fake_manager.resolve)
+
+    def test_create_no_deps(self):
+        requested = {
+            REPO_PYPI: [get_req('dep1 == 1.0')]
+        }
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = {'dep1': '1.0'}
+                envbuilder.create_venv(requested, no_deps=True)
+        self.assertTrue(fake_manager.no_deps)
+
+    def test_async_create(self):
+        requested = {
+            REPO_PYPI: [get_req('dep1 == v1'), get_req('dep2 == v2')]
+        }
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = ('env_path', 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = {'dep1': 'v1', 'dep2': 'v2'}
+                venv_data, installed = asyncio.run(envbuilder.async_create_venv(requested))
+
+        self.assertEqual(fake_manager.install_calls, 1)
+        self.assertEqual(venv_data['env_path'], 'env_path')
+        self.assertEqual(installed, {REPO_PYPI: {'dep1': 'v1', 'dep2': 'v2'}})
+        self.mock_store.return_value.share.assert_called_once_with(
+            envbuilder.get_site_packages('env_path'))
+
+    def test_async_create_cancelled(self):
+        tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, tempdir)
+        env_path = os.path.join(tempdir, 'venv')
+        os.mkdir(env_path)
+        requested = {REPO_PYPI: [get_req('dep1')]}
+
+        async def create_and_cancel():
+            task = asyncio.ensure_future(envbuilder.async_create_venv(requested))
+            while not fake_manager.install_calls:
+                await asyncio.sleep(.01)
+            task.cancel()
+            await task
+
+        with patch.object(envbuilder.FadesEnvBuilder, 'create_env') as mock_create:
+            with patch.object(envbuilder, 'PipManager') as mock_mgr_c:
+                mock_create.return_value = (env_path, 'env_bin_path', 'pip_installed')
+                mock_mgr_c.return_value = fake_manager = self.FakeManager()
+                fake_manager.really_installed = None
+                with self.assertRaises(asyncio.CancelledError):
+                    asyncio.run(create_and_cancel())
+
+        # the half built venv is gone
+        self.assertFalse(os.path.exists(env_path))
+
+
+class CloneTestCase(unittest.TestCase):
+    """Check the venv cloning."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.src = os.path.join(self.tempdir, 'src')
+        self.dst = os.path.join(self.tempdir, 'dst')
+
+        os.makedirs(os.path.join(self.src, 'bin'))
+        os.makedirs(os.path.join(self.src, 'lib'))
+        self.write('pyvenv.cfg', "home = /usr/bin\ncommand = venv {}\n".format(self.src))
+        self.write('bin/pip', "#!{}/bin/python\nimport pip\n".format(self.src))
+        os.chmod(os.path.join(self.src, 'bin', 'pip'), 0o755)
+        self.write('bin/other', "nothing to fix here")
+        self.write('lib/module.py', "# also made in {}".format(self.src))
+        os.symlink('/usr/bin/python3', os.path.join(self.src, 'bin', 'python'))
+
+    def write(self, path, content):
+        """Write content in the path inside the source venv."""
+        with open(os.path.join(self.src, path), 'wt', encoding='utf8') as fh:
+            fh.write(content)
+
+    def read(self, path):
+        """Read the content of the path inside the destination venv."""
+        with open(os.path.join(self.dst, path), 'rt', encoding='utf8') as fh:
+            return fh.read()
+
+    def test_paths_fixed(self):
+        envbuilder.clone_venv(self.src, self.dst)
+        self.assertEqual(self.read('pyvenv.cfg'),
+                         "home = /usr/bin\ncommand = venv {}\n".format(self.dst))
+        self.assertEqual(self.read('bin/pip'), "#!{}/bin/python\nimport pip\n".format(self.dst))
+        self.assertTrue(os.access(os.path.join(self.dst, 'bin', 'pip'), os.X_OK))
+
+        # the originals are untouched
+        with open(os.path.join(self.src, 'bin', 'pip'), 'rt', encoding='utf8') as fh:
+            self.assertEqual(fh.read(), "#!{}/bin/python\nimport pip\n".format(self.src))
+
+    def test_linked_files(self):
+        envbuilder.clone_venv(self.src, self.dst)
+        for path in ('bin/other', 'lib/module.py'):
+            self.assertTrue(os.path.samefile(os.path.join(self.src, path),
+                                             os.path.join(self.dst, path)))
+        self.assertFalse(os.path.samefile(os.path.join(self.src, 'bin', 'pip'),
+                                          os.path.join(self.dst, 'bin', 'pip')))
+
+    def test_symlinks_kept(self):
+        envbuilder.clone_venv(self.src, self.dst)
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'bin', 'python')), '/usr/bin/python3')
+
+
+class TemplateTestCase(unittest.TestCase):
+    """Check the venv creation using the template."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        patcher = patch.object(envbuilder, 'get_basedir')
+        patcher.start().return_value = self.tempdir
+        self.addCleanup(patcher.stop)
+
+    def fake_create(self, env_path):
+        """Just a directory with a bin inside."""
+        os.makedirs(os.path.join(env_path, 'bin'))
+
+    def test_template_built_once(self):
+        with patch.object(envbuilder.FadesEnvBuilder, 'create') as mock_create:
+            mock_create.side_effect = self.fake_create
+            env1 = envbuilder.FadesEnvBuilder()
+            env_path1, env_bin_path1, _ = env1.create_env()
+            env2 = envbuilder.FadesEnvBuilder()
+            env_path2, env_bin_path2, _ = env2.create_env()
+
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertTrue(os.path.islink(env1.template_path))
+        self.assertNotEqual(env_path1, env_path2)
+        self.assertEqual(env_bin_path2, os.path.join(env_path2, 'bin'))
+        self.assertTrue(os.path.isdir(env_bin_path1))
+        self.assertTrue(os.path.isdir(env_bin_path2))
+
+    def test_template_built_meanwhile(self):
+        env = envbuilder.FadesEnvBuilder()
+
+        def create_and_race(env_path):
+            """Create the venv, but other process finished its template first."""
+            self.fake_create(env_path)
+            self.fake_create(env.template_path)
+
+        with patch.object(envbuilder.FadesEnvBuilder, 'create') as mock_create:
+            mock_create.side_effect = create_and_race
+            env.create_env()
+
+        # only the other template is left
+        self.assertEqual(os.listdir(os.path.dirname(env.template_path)),
+                         [os.path.basename(env.template_path)])
+
+    def test_clone_source(self):
+        source = os.path.join(self.tempdir, 'source')
+        self.fake_create(source)
+        with patch.object(envbuilder.FadesEnvBuilder, 'create') as mock_create:
+            env = envbuilder.FadesEnvBuilder()
+            env_path, env_bin_path, _ = env.create_env(source)
+        self.assertFalse(mock_create.called)
+        self.assertFalse(os.path.exists(env.template_path))
+        self.assertTrue(os.path.isdir(env_bin_path))
+
+    def test_no_template(self):
+        with patch.object(envbuilder.FadesEnvBuilder, 'create') as mock_create:
+            env = envbuilder.FadesEnvBuilder(use_template=False)
+            env.create_env()
+        mock_create.assert_called_with(env.env_path)
+        self.assertFalse(os.path.exists(env.template_path))
+
+    def make_template(self, name, linked=False):
+        """Create a template as the builder does, with a venv cloned from it if linked."""
+        templates_dir = os.path.join(self.tempdir, 'templates')
+        build_path = os.path.join(templates_dir, name + '-build')
+        self.fake_create(build_path)
+        with open(os.path.join(build_path, 'pyvenv.cfg'), 'wt', encoding='utf8') as fh:
+            fh.write('home = /usr/bin\n')
+        os.symlink(os.path.basename(build_path), os.path.join(templates_dir, name))
+        if linked:
+            envbuilder.clone_venv(build_path, os.path.join(self.tempdir, name + '-venv'))
+        return build_path
+
+    def test_prune_templates(self):
+        current = os.path.basename(envbuilder.get_template_path(self.tempdir))
+        self.make_template(current)
+        self.make_template('python3.4-used', linked=True)
+        self.make_template('python3.4-unused')
+
+        envbuilder.prune_templates(self.tempdir)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir, 'templates'))), sorted([
+            'python3.4-used', 'python3.4-used-build', current, current + '-build']))
+
+    def test_prune_interrupted_builds(self):
+        current = envbuilder.get_template_path(self.tempdir)
+        old_build = self.make_template(os.path.basename(current)) + '-old'
+        self.fake_create(old_build)
+        os.utime(old_build, (0, 0))
+        new_build = current + '-new'
+        self.fake_create(new_build)
+
+        envbuilder.prune_templates(self.tempdir)
+        self.assertFalse(os.path.exists(old_build))
+        self.assertTrue(os.path.exists(new_build))
+
+    def test_prune_no_templates(self):
+        envbuilder.prune_templates(self.tempdir)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'templates')))
+
+    def test_added_versions(self):
+        template_bin_path = os.path.join(envbuilder.get_template_path(self.tempdir), 'bin')
+        os.makedirs(template_bin_path)
+        versions = {
+            template_bin_path: {'pip': '23.2', 'setuptools': '65.5'},
+            'env_bin_path': {'pip': '23.2', 'SetupTools': '70.0', 'dep': '1.0'},
+        }
+
+        def fake_installed_versions(mgr):
+            return versions[mgr.env_bin_path]
+
+        with patch.object(envbuilder.PipManager, 'get_installed_versions',
+                          fake_installed_versions):
+            with patch.object(pipmanager, 'get_basedir'):
+                added = envbuilder.get_added_versions('env_bin_path')
+        # setuptools was upgraded by a dependency, so it's not what the template has
+        self.assertEqual(added, {'SetupTools': '70.0', 'dep': '1.0'})
+
+    def test_added_versions_no_template(self):
+        with patch.object(envbuilder.PipManager, 'get_installed_versions') as mock:
+            mock.return_value = {'pip': '23.2', 'dep': '1.0'}
+            with patch.object(pipmanager, 'get_basedir'):
+                added = envbuilder.get_added_versions('env_bin_path')
+        self.assertEqual(added, {'pip': '23.2', 'dep': '1.0'})
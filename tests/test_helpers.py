@@ -0,0 +1,156 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the helpers."""
+
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest.mock import patch
+
+from fades import helpers
+
+
+class AsyncLoggedExecTestCase(unittest.TestCase):
+    """Execute commands without blocking."""
+
+    def test_output_logged(self):
+        cmd = [sys.executable, '-c', 'print("foo"); print("bar")']
+        with self.assertLogs('fades.exec', level='DEBUG') as logcheck:
+            asyncio.run(helpers.async_logged_exec(cmd))
+        self.assertIn(':: foo', logcheck.output[1])
+        self.assertIn(':: bar', logcheck.output[2])
+
+    def test_failure(self):
+        cmd = [sys.executable, '-c', 'import sys; sys.exit(3)']
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            asyncio.run(helpers.async_logged_exec(cmd))
+        self.assertEqual(cm.exception.returncode, 3)
+
+    def test_cancelled_killed(self):
+        tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, tempdir)
+        flag = os.path.join(tempdir, 'flag')
+        cmd = [sys.executable, '-c',
+               'import time; open({!r}, "w").close(); time.sleep(30)'.format(flag)]
+
+        async def run_and_cancel():
+            task = asyncio.ensure_future(helpers.async_logged_exec(cmd))
+            while not os.path.exists(flag):
+                await asyncio.sleep(.01)
+            task.cancel()
+            await task
+
+        start = time.monotonic()
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run_and_cancel())
+        self.assertLess(time.monotonic() - start, 10)
+
+
+class LockedTestCase(unittest.TestCase):
+    """Check the lock shared by processes."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.lock_path = os.path.join(self.tempdir, 'locks', 'foo')
+
+    def test_creates_lock_file(self):
+        with helpers.locked(self.lock_path):
+            self.assertTrue(os.path.exists(self.lock_path))
+
+    def test_exclusive(self):
+        events = []
+
+        def other():
+            with helpers.locked(self.lock_path):
+                events.append('other')
+
+        with helpers.locked(self.lock_path):
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join(.2)
+            # still waiting for the lock
+            self.assertTrue(thread.is_alive())
+            events.append('first')
+        thread.join()
+        self.assertEqual(events, ['first', 'other'])
+
+    def test_lock_file_removed_while_waiting(self):
+        inside = []
+
+        def other():
+            with helpers.locked(self.lock_path):
+                inside.append(os.path.exists(self.lock_path))
+
+        with helpers.locked(self.lock_path):
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join(.2)
+            # as remove_lock does, but while the other is waiting
+            os.remove(self.lock_path)
+        thread.join()
+        # the other locked the new lock file, not the removed one
+        self.assertEqual(inside, [True])
+
+    def test_remove_not_held(self):
+        with helpers.locked(self.lock_path):
+            pass
+        self.assertTrue(helpers.remove_lock(self.lock_path))
+        self.assertFalse(os.path.exists(self.lock_path))
+
+    def test_remove_held(self):
+        with helpers.locked(self.lock_path):
+            self.assertFalse(helpers.remove_lock(self.lock_path))
+        self.assertTrue(os.path.exists(self.lock_path))
+
+
+class AtomicWriteTestCase(unittest.TestCase):
+    """Check the atomic writing of files."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filepath = os.path.join(self.tempdir, 'foo')
+
+    def test_write(self):
+        helpers.atomic_write(self.filepath, "content")
+        with open(self.filepath, 'rt', encoding='utf8') as fh:
+            self.assertEqual(fh.read(), "content")
+        self.assertEqual(os.listdir(self.tempdir), ['foo'])
+
+    def test_overwrite(self):
+        helpers.atomic_write(self.filepath, "old content")
+        helpers.atomic_write(self.filepath, "new")
+        with open(self.filepath, 'rt', encoding='utf8') as fh:
+            self.assertEqual(fh.read(), "new")
+
+    def test_error_leaves_previous(self):
+        helpers.atomic_write(self.filepath, "old content")
+        with patch.object(helpers.os, 'fsync') as mock:
+            mock.side_effect = OSError("disk full")
+            with self.assertRaises(OSError):
+                helpers.atomic_write(self.filepath, "new")
+        with open(self.filepath, 'rt', encoding='utf8') as fh:
+            self.assertEqual(fh.read(), "old content")
+        self.assertEqual(os.listdir(self.tempdir), ['foo'])
@@ -0,0 +1,78 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the lock files of the child programs."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from packaging.requirements import Requirement
+
+from fades import lockfile
+
+
+class LockFileTestCase(unittest.TestCase):
+    """Write and read the lock files."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filepath = os.path.join(self.tempdir, 'lockfiles', 'script.json')
+        self.requested = {'pypi': [Requirement('foo >= 1'), Requirement('bar')]}
+
+    def test_path_by_child_program(self):
+        script = os.path.join(self.tempdir, 'script.py')
+        path1 = lockfile.get_path('basedir', script)
+        path2 = lockfile.get_path('basedir', os.path.join(self.tempdir, 'sub', '..', 'script.py'))
+        path3 = lockfile.get_path('basedir', os.path.join(self.tempdir, 'other.py'))
+        self.assertEqual(path1, path2)
+        self.assertNotEqual(path1, path3)
+        self.assertEqual(os.path.dirname(path1), os.path.join('basedir', 'lockfiles'))
+
+    def test_missing(self):
+        self.assertIsNone(lockfile.read(self.filepath, self.requested))
+
+    def test_write_read(self):
+        installed = {'pypi': {'foo': '1.5', 'bar': '2.0', 'baz': '3.0'}}
+        lockfile.write(self.filepath, self.requested, installed, {'env_path': 'venv'})
+        lock = lockfile.read(self.filepath, self.requested)
+        self.assertEqual(lock['installed'], installed)
+        self.assertEqual(lock['metadata'], {'env_path': 'venv'})
+
+    def test_same_requirements_other_order(self):
+        lockfile.write(self.filepath, self.requested, {'pypi': {}}, {})
+        requested = {'pypi': [Requirement('Bar'), Requirement('foo>=1')]}
+        self.assertIsNotNone(lockfile.read(self.filepath, requested))
+
+    def test_other_requirements(self):
+        lockfile.write(self.filepath, self.requested, {'pypi': {}}, {})
+        requested = {'pypi': [Requirement('foo >= 2'), Requirement('bar')]}
+        self.assertIsNone(lockfile.read(self.filepath, requested))
+
+    def test_broken(self):
+        os.makedirs(os.path.dirname(self.filepath))
+        with open(self.filepath, 'wt', encoding='utf8') as fh:
+            fh.write('{"broken')
+        with self.assertLogs('fades.lockfile', level=logging.WARNING):
+            self.assertIsNone(lockfile.read(self.filepath, self.requested))
+
+    def test_pinned(self):
+        lock = {'installed': {'pypi': {'foo': '1.5', 'Bar_Baz': '2.0'}}}
+        pinned = lockfile.get_pinned(lock)
+        self.assertEqual([str(req) for req in pinned['pypi']], ['Bar_Baz==2.0', 'foo==1.5'])
@@ -16,9 +16,20 @@
 
 """Tests for the main module."""
 
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 
-from fades import main
+from unittest.mock import Mock, patch
+
+from packaging.requirements import Requirement
+
+from fades import cache, envbuilder, lockfile, main, parsing
 
 
 class ArgvParsingTestCase(unittest.TestCase):
@@ -65,3 +76,254 @@ class ArgvParsingTestCase(unittest.TestCase):
         self.assertEqual(fo, ["-v"])
         self.assertEqual(cp, "bar.py")
         self.assertEqual(co, ["-k", "--p=3"])
+
+
+class RunChildTestCase(unittest.TestCase):
+    """Check how the child program is run."""
+
+    def test_subprocess(self):
+        with patch.object(main.subprocess, 'Popen') as mock_popen:
+            with patch.object(main.os, 'execv') as mock_execv:
+                mock_popen.return_value.wait.return_value = 3
+                rc = main._run_child('python', 'foo.py', ['-k'])
+        mock_popen.assert_called_with(['python', 'foo.py', '-k'])
+        self.assertFalse(mock_execv.called)
+        self.assertEqual(rc, 3)
+
+    def test_replace_process(self):
+        with patch.object(main.subprocess, 'Popen') as mock_popen:
+            with patch.object(main.os, 'execv') as mock_execv:
+                with patch.object(main.logging, 'shutdown'):
+                    # the real execv never returns
+                    mock_execv.side_effect = SystemExit
+                    with self.assertRaises(SystemExit):
+                        main._run_child('python', 'foo.py', ['-k'], replace_process=True)
+        mock_execv.assert_called_with('python', ['python', 'foo.py', '-k'])
+        self.assertFalse(mock_popen.called)
+
+    def test_timing_reported_after_launch(self):
+        events = []
+        with patch.object(main.subprocess, 'Popen') as mock_popen:
+            with patch.object(main.timing, 'report') as mock_report:
+                mock_popen.side_effect = lambda cmd: events.append('launch') or mock_popen
+                mock_report.side_effect = lambda filepath: events.append(filepath)
+                mock_popen.wait.side_effect = lambda: events.append('finish') or 0
+                main._run_child('python', 'foo.py', [], timing_report='report.json')
+        self.assertEqual(events, ['launch', 'report.json', 'finish'])
+
+    def test_timing_reported_before_replacing(self):
+        with patch.object(main.os, 'execv') as mock_execv:
+            with patch.object(main.logging, 'shutdown'):
+                with patch.object(main.timing, 'report') as mock_report:
+                    mock_execv.side_effect = SystemExit
+                    with self.assertRaises(SystemExit):
+                        main._run_child('python', 'foo.py', [], replace_process=True,
+                                        timing_report='report.json')
+        mock_report.assert_called_once_with('report.json')
+
+
+class OptionsTestCase(unittest.TestCase):
+    """Check the options with values."""
+
+    def test_option_value(self):
+        value = main._get_option_value(["-v", "--foo=bar"], "--foo")
+        self.assertEqual(value, "bar")
+
+    def test_option_value_missing(self):
+        value = main._get_option_value(["-v", "--foobar=3"], "--foo")
+        self.assertEqual(value, None)
+
+    def test_gc_limits(self):
+        limits = main._get_gc_limits(
+            ["--gc-max-age=2", "--gc-max-count=5", "--gc-max-size=1.5"])
+        self.assertEqual(limits, {
+            'max_age': 2 * 24 * 60 * 60,
+            'max_count': 5,
+            'max_size': 1.5 * 1024 * 1024,
+        })
+
+    def test_gc_limits_none(self):
+        self.assertEqual(main._get_gc_limits(["-v"]), {})
+
+    def test_gc_limits_bad(self):
+        with self.assertRaises(ValueError):
+            main._get_gc_limits(["--gc-max-count=lots"])
+
+    def test_workers(self):
+        self.assertEqual(main._get_workers(["--workers=3"]), 3)
+
+    def test_workers_default(self):
+        self.assertEqual(main._get_workers([]), os.cpu_count() or 1)
+
+    def test_workers_bad(self):
+        for value in ("lots", "0", "-2"):
+            with self.assertRaises(ValueError):
+                main._get_workers(["--workers=" + value])
+
+
+class PrepareTestCase(unittest.TestCase):
+    """Prepare the venvs for several scripts."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        handler = logging.NullHandler()
+        logging.getLogger('fades').addHandler(handler)
+        self.addCleanup(logging.getLogger('fades').removeHandler, handler)
+
+    def make_script(self, name, content):
+        """Write a script in the temp dir."""
+        path = os.path.join(self.tempdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt', encoding='utf8') as fh:
+            fh.write(content)
+        return path
+
+    def test_find_scripts(self):
+        script1 = self.make_script('foo.py', '')
+        script2 = self.make_script('dir/sub/bar.py', '')
+        script3 = self.make_script('dir/baz.py', '')
+        self.make_script('dir/other.txt', '')
+        scripts = main._find_scripts([script1, os.path.join(self.tempdir, 'dir')])
+        self.assertEqual(scripts, [script1, script3, script2])
+
+    def prepare(self, scripts, workers=2, existing=()):
+        """Prepare the scripts faking the venvs creation, return what was created."""
+        created = []
+        running = []
+        max_running = []
+
+        async def fake_create(requested_deps, resolutions=None):
+            running.append(requested_deps)
+            max_running.append(len(running))
+            await asyncio.sleep(.01)
+            running.remove(requested_deps)
+            if 'broken' in str(requested_deps):
+                raise subprocess.CalledProcessError(1, 'pip')
+            created.append(requested_deps)
+            return 'venv_data', 'installed'
+
+        venvscache = Mock()
+        venvscache.lock.side_effect = lambda requested_deps: contextlib.ExitStack()
+        venvscache.get_venv.side_effect = (
+            lambda requested_deps: 'venv' if str(requested_deps) in existing else None)
+        with patch.object(envbuilder, 'async_create_venv', fake_create):
+            failed = main._prepare(venvscache, scripts, None, [], workers)
+        self.max_running = max(max_running, default=0)
+        self.venvscache = venvscache
+        return failed, created
+
+    def test_dependencies_deduplicated(self):
+        scripts = [
+            self.make_script('foo.py', 'import foo  # fades.pypi\nimport bar  # fades.pypi\n'),
+            self.make_script('bar.py', 'import bar  # fades.pypi\nimport foo  # fades.pypi\n'),
+            self.make_script('baz.py', 'import foo  # fades.pypi\n'),
+        ]
+        failed, created = self.prepare(scripts)
+        self.assertEqual(failed, 0)
+        self.assertEqual(sorted(len(deps['pypi']) for deps in created), [1, 2])
+        self.assertEqual(self.venvscache.store.call_count, 2)
+
+    def test_bounded_parallelism(self):
+        scripts = [self.make_script('{}.py'.format(name),
+                                    'import {}  # fades.pypi\n'.format(name))
+                   for name in ('foo', 'bar', 'baz', 'qux')]
+        failed, created = self.prepare(scripts, workers=2)
+        self.assertEqual(failed, 0)
+        self.assertEqual(len(created), 4)
+        self.assertEqual(self.max_running, 2)
+
+    def test_existing_not_created(self):
+        script = self.make_script('foo.py', 'import foo  # fades.pypi\n')
+        existing = str(parsing.parse_file(script))
+        failed, created = self.prepare([script], existing=(existing,))
+        self.assertEqual(failed, 0)
+        self.assertEqual(created, [])
+        self.assertFalse(self.venvscache.store.called)
+
+    def test_failures(self):
+        scripts = [self.make_script('foo.py', 'import foo  # fades.pypi\n'),
+                   self.make_script('bar.py', 'import broken  # fades.pypi\n'),
+                   os.path.join(self.tempdir, 'missing.py')]
+        failed, created = self.prepare(scripts)
+        self.assertEqual(failed, 2)
+        self.assertEqual(len(created), 1)
+
+
+class LockedVenvTestCase(unittest.TestCase):
+    """Get the venv through the child program's lock file."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.lock_path = os.path.join(self.tempdir, 'lockfiles', 'script.json')
+        self.requested = {'pypi': [Requirement('foo >= 1')]}
+        self.venvscache = Mock()
+        self.venvscache.lock.side_effect = lambda requested_deps: contextlib.ExitStack()
+        self.venvscache.is_alive.side_effect = cache.VEnvsCache(
+            os.path.join(self.tempdir, 'venvs.idx')).is_alive
+
+    def make_venv(self, name):
+        """Build the structure of a venv, return its data."""
+        env_path = os.path.join(self.tempdir, name)
+        os.makedirs(os.path.join(env_path, 'bin'))
+        open(os.path.join(env_path, 'bin', 'python3'), 'wb').close()
+        return {'env_path': env_path, 'env_bin_path': os.path.join(env_path, 'bin')}
+
+    def get_locked_venv(self, requested=None):
+        return main._get_locked_venv(
+            self.venvscache, requested or self.requested, self.lock_path, [], {})
+
+    def test_lock_written(self):
+        venv_data = self.make_venv('venv1')
+        with patch.object(main, '_get_venv', return_value=venv_data):
+            with patch.object(envbuilder, 'get_added_versions') as mock_versions:
+                mock_versions.return_value = {'foo': '1.5', 'bar': '2.0'}
+                self.assertEqual(self.get_locked_venv(), venv_data)
+
+        lock = lockfile.read(self.lock_path, self.requested)
+        self.assertEqual(lock['installed'], {'pypi': {'foo': '1.5', 'bar': '2.0'}})
+        self.assertEqual(lock['metadata'], venv_data)
+
+    def test_lock_used(self):
+        venv_data = self.make_venv('venv1')
+        lockfile.write(self.lock_path, self.requested, {'pypi': {'foo': '1.5'}}, venv_data)
+        with patch.object(main, '_get_venv') as mock_get_venv:
+            self.assertEqual(self.get_locked_venv(), venv_data)
+        self.assertFalse(mock_get_venv.called)
+        self.assertFalse(self.venvscache.get_venv.called)
+        self.venvscache.mark_used.assert_called_once_with(venv_data)
+
+    def test_venv_gone(self):
+        venv_data = self.make_venv('venv1')
+        lockfile.write(self.lock_path, self.requested,
+                       {'pypi': {'foo': '1.5', 'bar': '2.0'}}, venv_data)
+        shutil.rmtree(venv_data['env_path'])
+
+        new_venv_data = self.make_venv('venv2')
+        installed = {'pypi': {'foo': '1.5', 'bar': '2.0'}}
+        with patch.object(envbuilder, 'create_venv') as mock_create:
+            mock_create.return_value = (new_venv_data, installed)
+            self.assertEqual(self.get_locked_venv(), new_venv_data)
+
+        # exactly what was locked, without dependencies
+        (pinned,), kwargs = mock_create.call_args
+        self.assertEqual([str(req) for req in pinned['pypi']], ['bar==2.0', 'foo==1.5'])
+        self.assertEqual(kwargs, {'no_deps': True})
+        # indexed only with what was required
+        self.venvscache.store.assert_called_once_with(
+            {'pypi': {'foo': '1.5'}}, new_venv_data, self.requested)
+        lock = lockfile.read(self.lock_path, self.requested)
+        self.assertEqual(lock['metadata'], new_venv_data)
+
+    def test_dependencies_changed(self):
+        venv_data = self.make_venv('venv1')
+        lockfile.write(self.lock_path, self.requested, {'pypi': {'foo': '1.5'}}, venv_data)
+
+        requested = {'pypi': [Requirement('foo >= 1'), Requirement('bar')]}
+        new_venv_data = self.make_venv('venv2')
+        with patch.object(main, '_get_venv', return_value=new_venv_data):
+            with patch.object(envbuilder, 'get_added_versions') as mock_versions:
+                mock_versions.return_value = {'foo': '1.5', 'bar': '2.0'}
+                self.assertEqual(self.get_locked_venv(requested), new_venv_data)
+        self.assertEqual(lockfile.read(self.lock_path, requested)['metadata'], new_venv_data)
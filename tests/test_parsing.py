@@ -18,16 +18,21 @@
 
 import io
 import logging
+import os
+import shutil
+import tempfile
 import unittest
 
-from pkg_resources import parse_requirements
+from unittest.mock import patch
+
+from packaging.requirements import Requirement
 
 from fades import parsing, REPO_PYPI
 
 
 def get_req(text):
-    """Transform a text requirement into the pkg_resources object."""
-    return list(parse_requirements(text))[0]
+    """Transform a text requirement into the packaging object."""
+    return Requirement(text)
 
 
 class PyPIParsingTestCase(unittest.TestCase):
@@ -338,3 +343,185 @@ class PyPIParsingTestCase(unittest.TestCase):
         self.assertDictEqual(parsed, {
             REPO_PYPI: [get_req('bar')]
         })
+
+
+class MarkedLinesTestCase(unittest.TestCase):
+    """Check that parsing only the marked lines is the same as parsing all the file."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def check(self, content):
+        """Parse the content from a file, checking it's the same as parsing all of it."""
+        filepath = os.path.join(self.tempdir, 'script.py')
+        with open(filepath, 'wb') as fh:
+            fh.write(content.encode('utf8'))
+        with open(filepath, 'rt', encoding='utf8') as fh:
+            expected = parsing._parse_content(fh)
+        parsed = parsing.parse_file(filepath)
+        self.assertDictEqual(parsed, expected)
+        return parsed
+
+    def test_empty(self):
+        self.assertDictEqual(self.check(""), {})
+
+    def test_nothing_marked(self):
+        self.assertDictEqual(self.check("import foo\n" * 100), {})
+
+    def test_among_other_lines(self):
+        parsed = self.check(
+            "import os\n" * 100 + "import foo  # fades.pypi >= 2\n" + "x = 3\n" * 100 +
+            "# fades.pypi\nfrom bar import baz\n" + "print('fades')\n" + "y = 4\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo >= 2'), get_req('bar')]})
+
+    def test_consecutive_marks(self):
+        parsed = self.check(
+            "import foo  # fades.pypi\n# fades.pypi\nimport bar\n# fades.pypi\nimport baz\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [
+            get_req('foo'), get_req('bar'), get_req('baz')]})
+
+    def test_several_marks_same_line(self):
+        parsed = self.check("import foo  # the fades mark: # fades.pypi\nimport bar\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+    def test_no_final_newline(self):
+        parsed = self.check("import bar\nimport foo  # fades.pypi")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+    def test_mark_before_last_line(self):
+        parsed = self.check("# fades.pypi\nimport foo")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+    def test_other_newlines(self):
+        parsed = self.check("import foo  # fades.pypi\r\n# fades.pypi\r\nimport bar\r\n"
+                            "x = 1\rimport baz  # fades.pypi\r")
+        self.assertDictEqual(parsed, {REPO_PYPI: [
+            get_req('foo'), get_req('bar'), get_req('baz')]})
+
+    def test_non_ascii(self):
+        parsed = self.check("# ñandú fades\nimport foo  # fades.pypi\ns = 'ñ'\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+
+class HeaderOnlyTestCase(unittest.TestCase):
+    """Check the parsing of only the file's header."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.script = os.path.join(self.tempdir, 'script.py')
+
+    def parse(self, content, **kwargs):
+        """Write the content and parse only its header."""
+        with open(self.script, 'wt', encoding='utf8') as fh:
+            fh.write(content)
+        return parsing.parse_file(self.script, header_only=True, **kwargs)
+
+    def test_stops_after_imports(self):
+        parsed = self.parse("import foo  # fades.pypi\n\nx = 3\nimport bar  # fades.pypi\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+    def test_docstring_comments_and_multiline_imports(self):
+        parsed = self.parse(
+            '#!/usr/bin/fades\n"""The docstring.\n\nMore text.\n"""\n'
+            '# some comment\nfrom bar import (  # fades.pypi\n    baz,\n)\n\n'
+            '# fades.pypi >= 2\nimport qux\n'
+            'def main():\n    import other  # fades.pypi\n')
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('bar'), get_req('qux >= 2')]})
+
+    def test_only_first_string_is_docstring(self):
+        parsed = self.parse('"""Doc."""\n"""Other."""\nimport foo  # fades.pypi\n')
+        self.assertDictEqual(parsed, {})
+
+    def test_whole_file_is_header(self):
+        parsed = self.parse("import foo  # fades.pypi\nimport bar  # fades.pypi")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo'), get_req('bar')]})
+
+    def test_mark_before_the_end(self):
+        parsed = self.parse("import foo  # fades.pypi\n# fades.pypi\nx = 3\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+    def test_not_read_after_header(self):
+        with open(self.script, 'wb') as fh:
+            fh.write(b"import foo  # fades.pypi\nx = 3\n# \xff\xfe not even utf8\n")
+        parsed = parsing.parse_file(self.script, header_only=True)
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo')]})
+
+    def test_broken_file_parsed_whole(self):
+        parsed = self.parse("import foo  # fades.pypi\nfrom bar import (  # fades.pypi\n")
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo'), get_req('bar')]})
+
+    def test_cached_apart(self):
+        cachedir = os.path.join(self.tempdir, 'parsed')
+        content = "import foo  # fades.pypi\nx = 3\nimport bar  # fades.pypi\n"
+        self.assertDictEqual(self.parse(content, cachedir=cachedir), {
+            REPO_PYPI: [get_req('foo')]})
+        self.assertDictEqual(parsing.parse_file(self.script, cachedir), {
+            REPO_PYPI: [get_req('foo'), get_req('bar')]})
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    """Check the cache of parsed files."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.cachedir = os.path.join(self.tempdir, 'parsed')
+        self.script = os.path.join(self.tempdir, 'script.py')
+        self.write_script("import foo    # fades.pypi >= 2\n")
+
+    def write_script(self, content, mtime=1000000000):
+        """Write the script, forcing its modification time."""
+        with open(self.script, 'wt', encoding='utf8') as fh:
+            fh.write(content)
+        os.utime(self.script, (mtime, mtime))
+
+    def test_no_cache(self):
+        parsed = parsing.parse_file(self.script)
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo >= 2')]})
+        self.assertFalse(os.path.exists(self.cachedir))
+
+    def test_parsed_once(self):
+        parsed1 = parsing.parse_file(self.script, self.cachedir)
+        with patch.object(parsing, '_parse_content') as mock:
+            parsed2 = parsing.parse_file(self.script, self.cachedir)
+        self.assertFalse(mock.called)
+        self.assertDictEqual(parsed1, {REPO_PYPI: [get_req('foo >= 2')]})
+        self.assertDictEqual(parsed2, parsed1)
+
+    def test_nothing_marked(self):
+        self.write_script("import foo\n")
+        parsing.parse_file(self.script, self.cachedir)
+        with patch.object(parsing, '_parse_content') as mock:
+            parsed = parsing.parse_file(self.script, self.cachedir)
+        self.assertFalse(mock.called)
+        self.assertDictEqual(parsed, {})
+
+    def test_changed_size(self):
+        parsing.parse_file(self.script, self.cachedir)
+        self.write_script("import foo    # fades.pypi >= 3\nimport bar    # fades.pypi\n")
+        parsed = parsing.parse_file(self.script, self.cachedir)
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo >= 3'), get_req('bar')]})
+
+    def test_changed_mtime(self):
+        parsing.parse_file(self.script, self.cachedir)
+        self.write_script("import foo    # fades.pypi >= 3\n", mtime=1000000005)
+        parsed = parsing.parse_file(self.script, self.cachedir)
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo >= 3')]})
+
+    def test_cache_file_written_atomically(self):
+        with patch.object(parsing, 'atomic_write', wraps=parsing.atomic_write) as mock:
+            parsing.parse_file(self.script, self.cachedir)
+        self.assertTrue(mock.called)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+    def test_broken_cache_file(self):
+        parsing.parse_file(self.script, self.cachedir)
+        for fname in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, fname), 'wt', encoding='utf8') as fh:
+                fh.write('{"broken')
+        with self.assertLogs('fades.parsing', level=logging.WARNING) as logcheck:
+            parsed = parsing.parse_file(self.script, self.cachedir)
+        self.assertDictEqual(parsed, {REPO_PYPI: [get_req('foo >= 2')]})
+        self.assertIn("Ignoring broken parse cache file", logcheck.output[0])
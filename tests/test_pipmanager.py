@@ -0,0 +1,174 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the pip manager."""
+
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from unittest.mock import call, patch
+
+from fades import pipmanager
+
+
+class PipManagerTestCase(unittest.TestCase):
+    """Check the pip related actions."""
+
+    def setUp(self):
+        patcher = patch.object(pipmanager, 'get_basedir')
+        patcher.start().return_value = 'basedir'
+        self.addCleanup(patcher.stop)
+        self.mgr = pipmanager.PipManager('env_bin_path', pip_installed=True)
+
+    def test_install_several(self):
+        with patch.object(pipmanager, 'logged_exec') as mock:
+            with patch.object(pipmanager.os, 'makedirs'):
+                self.mgr.install('foo', 'bar >= 2')
+        mock.assert_called_with(['env_bin_path/pip', 'install', '--no-index', '--find-links',
+                                 'basedir/wheels', 'foo', 'bar >= 2'])
+
+    def test_install_not_in_wheelhouse(self):
+        with patch.object(pipmanager, 'logged_exec') as mock:
+            with patch.object(pipmanager.os, 'makedirs'):
+                mock.side_effect = [pipmanager.subprocess.CalledProcessError(1, 'pip'), None, None]
+                self.mgr.install('foo')
+        install_args = ['env_bin_path/pip', 'install', '--no-index', '--find-links',
+                        'basedir/wheels', 'foo']
+        self.assertEqual(mock.call_args_list, [
+            call(install_args),
+            call(['env_bin_path/pip', 'wheel', '--wheel-dir', 'basedir/wheels',
+                  '--find-links', 'basedir/wheels', 'foo']),
+            call(install_args),
+        ])
+
+    def test_install_resolve(self):
+        with patch.object(pipmanager, 'logged_exec') as mock:
+            with patch.object(pipmanager.os, 'makedirs'):
+                self.mgr.install('foo >= 2', resolve=True)
+        install_args = ['env_bin_path/pip', 'install', '--no-index', '--find-links',
+                        'basedir/wheels', 'foo >= 2']
+        # the wheelhouse is not tried first
+        self.assertEqual(mock.call_args_list, [
+            call(['env_bin_path/pip', 'wheel', '--wheel-dir', 'basedir/wheels',
+                  '--find-links', 'basedir/wheels', 'foo >= 2']),
+            call(install_args),
+        ])
+
+    def test_async_install_resolve(self):
+        calls = []
+
+        async def fake_exec(cmd):
+            calls.append(cmd)
+
+        with patch.object(pipmanager, 'async_logged_exec', fake_exec):
+            with patch.object(pipmanager.os, 'makedirs'):
+                asyncio.run(self.mgr.async_install('foo >= 2', resolve=True))
+        self.assertEqual([cmd[1] for cmd in calls], ['wheel', 'install'])
+
+    def test_install_no_deps(self):
+        with patch.object(pipmanager, 'logged_exec') as mock:
+            with patch.object(pipmanager.os, 'makedirs'):
+                mock.side_effect = [pipmanager.subprocess.CalledProcessError(1, 'pip'), None, None]
+                self.mgr.install('foo==1.0', no_deps=True)
+        install_args = ['env_bin_path/pip', 'install', '--no-index', '--find-links',
+                        'basedir/wheels', '--no-deps', 'foo==1.0']
+        self.assertEqual(mock.call_args_list, [
+            call(install_args),
+            call(['env_bin_path/pip', 'wheel', '--no-deps', '--wheel-dir', 'basedir/wheels',
+                  '--find-links', 'basedir/wheels', 'foo==1.0']),
+            call(install_args),
+        ])
+
+    def test_async_install_not_in_wheelhouse(self):
+        calls = []
+
+        async def fake_exec(cmd):
+            calls.append(cmd)
+            if len(calls) == 1:
+                raise pipmanager.subprocess.CalledProcessError(1, 'pip')
+
+        with patch.object(pipmanager, 'async_logged_exec', fake_exec):
+            with patch.object(pipmanager.os, 'makedirs'):
+                asyncio.run(self.mgr.async_install('foo'))
+        install_args = ['env_bin_path/pip', 'install', '--no-index', '--find-links',
+                        'basedir/wheels', 'foo']
+        self.assertEqual(calls, [
+            install_args,
+            ['env_bin_path/pip', 'wheel', '--wheel-dir', 'basedir/wheels',
+             '--find-links', 'basedir/wheels', 'foo'],
+            install_args,
+        ])
+
+    def test_async_install_error_raised(self):
+        async def fake_exec(cmd):
+            raise pipmanager.subprocess.CalledProcessError(1, 'pip')
+
+        with patch.object(pipmanager, 'async_logged_exec', fake_exec):
+            with patch.object(pipmanager.os, 'makedirs'):
+                with self.assertLogs('fades.pipmanager', level=logging.ERROR):
+                    with self.assertRaises(pipmanager.subprocess.CalledProcessError):
+                        asyncio.run(self.mgr.async_install('foo'))
+
+
+class InstalledVersionsTestCase(unittest.TestCase):
+    """Check the versions got from the venv's installed metadata."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.site_packages = os.path.join(
+            self.tempdir, 'lib', 'python%d.%d' % sys.version_info[:2], 'site-packages')
+        os.makedirs(self.site_packages)
+
+        patcher = patch.object(pipmanager, 'get_basedir')
+        patcher.start().return_value = 'basedir'
+        self.addCleanup(patcher.stop)
+        self.mgr = pipmanager.PipManager(os.path.join(self.tempdir, 'bin'), pip_installed=True)
+
+    def write_metadata(self, path, content):
+        """Write the metadata file, creating its dir if needed."""
+        path = os.path.join(self.site_packages, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt', encoding='utf8') as fh:
+            fh.write(content)
+
+    def test_empty(self):
+        self.assertEqual(self.mgr.get_installed_versions(), {})
+
+    def test_dist_info(self):
+        self.write_metadata('Foo_Bar-1.2.dist-info/METADATA',
+                            "Metadata-Version: 2.1\nName: Foo-Bar\nVersion: 1.2\n\n"
+                            "Version: not a header, the description\n")
+        self.write_metadata('baz-3.dist-info/METADATA', "Name: baz\nVersion: 3\n")
+        self.assertEqual(self.mgr.get_installed_versions(), {'Foo-Bar': '1.2', 'baz': '3'})
+
+    def test_egg_info(self):
+        self.write_metadata('foo-1.2.egg-info/PKG-INFO', "Name: foo\nVersion: 1.2\n")
+        self.write_metadata('bar-3.egg-info', "Name: bar\nVersion: 3\n")
+        self.assertEqual(self.mgr.get_installed_versions(), {'foo': '1.2', 'bar': '3'})
+
+    def test_broken_metadata(self):
+        self.write_metadata('foo-1.2.dist-info/METADATA', "Name: foo\n")
+        os.makedirs(os.path.join(self.site_packages, 'bar-3.dist-info'))
+        with self.assertLogs('fades.pipmanager', level=logging.WARNING) as logcheck:
+            versions = self.mgr.get_installed_versions()
+        self.assertEqual(versions, {})
+        self.assertEqual(len(logcheck.records), 2)
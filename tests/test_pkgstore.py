@@ -0,0 +1,140 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the store of installed packages."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fades import pkgstore
+
+
+class ShareTestCase(unittest.TestCase):
+    """Check the packages sharing through the store."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.store = pkgstore.PackagesStore(self.tempdir)
+
+    def install(self, venv, content="print('foo')", version='1.0'):
+        """Fake the installation of a package in a venv; return its site-packages."""
+        site_packages = os.path.join(self.tempdir, venv)
+        files = {
+            'foo/__init__.py': (content, 'sha256=' + content),
+            'foo/__pycache__/__init__.pyc': ('compiled ' + content, ''),
+            'foo-{}.dist-info/METADATA'.format(version): (
+                'Name: Foo\nVersion: {}\n'.format(version), 'sha256=metadata'),
+        }
+        record = ''.join('{},{},0\n'.format(path, file_hash)
+                         for path, (_, file_hash) in sorted(files.items()))
+        record += '../../../bin/foo,sha256=script,0\n'
+        record += 'foo-{}.dist-info/RECORD,,\n'.format(version)
+        files['foo-{}.dist-info/RECORD'.format(version)] = (record, '')
+        for path, (file_content, _) in files.items():
+            path = os.path.join(site_packages, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wt', encoding='utf8') as fh:
+                fh.write(file_content)
+        return site_packages
+
+    def assertShared(self, site_packages1, site_packages2, path):
+        """Assert that the file is the same one in both venvs."""
+        self.assertTrue(os.path.samefile(os.path.join(site_packages1, path),
+                                         os.path.join(site_packages2, path)))
+
+    def assertNotShared(self, site_packages1, site_packages2, path):
+        """Assert that the file is not the same one in both venvs."""
+        self.assertFalse(os.path.samefile(os.path.join(site_packages1, path),
+                                          os.path.join(site_packages2, path)))
+
+    def test_first_venv_populates(self):
+        site_packages = self.install('venv1')
+        self.store.share(site_packages)
+        entry = os.path.join(self.store.store_path, 'foo-1.0')
+        self.assertTrue(os.path.samefile(os.path.join(entry, 'foo', '__init__.py'),
+                                         os.path.join(site_packages, 'foo', '__init__.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.store.store_path, 'bin')))
+
+    def test_same_package_shared(self):
+        site_packages1 = self.install('venv1')
+        self.store.share(site_packages1)
+        site_packages2 = self.install('venv2')
+        self.store.share(site_packages2)
+
+        self.assertShared(site_packages1, site_packages2, 'foo/__init__.py')
+        self.assertShared(site_packages1, site_packages2, 'foo/__pycache__/__init__.pyc')
+        # the RECORD has no hash, it's always the venv's own
+        self.assertNotShared(site_packages1, site_packages2, 'foo-1.0.dist-info/RECORD')
+
+    def test_different_content_not_shared(self):
+        site_packages1 = self.install('venv1')
+        self.store.share(site_packages1)
+        site_packages2 = self.install('venv2', content="print('other')")
+        self.store.share(site_packages2)
+
+        self.assertNotShared(site_packages1, site_packages2, 'foo/__init__.py')
+        with open(os.path.join(site_packages2, 'foo', '__init__.py'), 'rt') as fh:
+            self.assertEqual(fh.read(), "print('other')")
+
+    def test_different_version_not_shared(self):
+        site_packages1 = self.install('venv1')
+        self.store.share(site_packages1)
+        site_packages2 = self.install('venv2', version='2.0')
+        self.store.share(site_packages2)
+
+        self.assertNotShared(site_packages1, site_packages2, 'foo/__init__.py')
+        self.assertEqual(sorted(os.listdir(self.store.store_path)), ['foo-1.0', 'foo-2.0'])
+
+    def test_prune_not_used(self):
+        site_packages1 = self.install('venv1')
+        self.store.share(site_packages1)
+        site_packages2 = self.install('venv2')
+        self.store.share(site_packages2)
+
+        # still used by the second venv
+        shutil.rmtree(site_packages1)
+        pkgstore.prune(self.tempdir)
+        self.assertEqual(os.listdir(self.store.store_path), ['foo-1.0'])
+
+        shutil.rmtree(site_packages2)
+        pkgstore.prune(self.tempdir)
+        self.assertEqual(os.listdir(self.store.store_path), [])
+
+    def test_prune_other_interpreters(self):
+        entry_path = os.path.join(self.tempdir, 'packages', 'python2.7', 'foo-1.0')
+        os.makedirs(entry_path)
+        with open(os.path.join(entry_path, 'foo.py'), 'wt', encoding='utf8') as fh:
+            fh.write("print('foo')")
+        pkgstore.prune(self.tempdir)
+        self.assertFalse(os.path.exists(entry_path))
+
+    def test_removed_while_sharing(self):
+        site_packages1 = self.install('venv1')
+        self.store.share(site_packages1)
+        entry_path = os.path.join(self.store.store_path, 'foo-1.0')
+        os.remove(os.path.join(entry_path, 'foo-1.0.dist-info', 'RECORD'))
+        site_packages2 = self.install('venv2')
+        self.store.share(site_packages2)
+        self.assertNotShared(site_packages1, site_packages2, 'foo/__init__.py')
+
+    def test_broken_package_ignored(self):
+        site_packages = os.path.join(self.tempdir, 'venv1')
+        os.makedirs(os.path.join(site_packages, 'foo-1.0.dist-info'))
+        self.store.share(site_packages)
+        self.assertFalse(os.path.exists(self.store.store_path))
@@ -0,0 +1,106 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the cache of resolved versions."""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from packaging.requirements import Requirement
+
+from fades import resolutions
+
+
+def get_reqs(*texts):
+    """Transform text requirements into packaging objects."""
+    return [Requirement(text) for text in texts]
+
+
+class ResolutionsCacheTestCase(unittest.TestCase):
+    """Pin the requirements to the resolved versions."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filepath = os.path.join(self.tempdir, 'resolutions.json')
+        self.resolutions = resolutions.ResolutionsCache(self.filepath, ttl=100)
+
+    def test_nothing_resolved(self):
+        reqs = get_reqs('foo >= 2', 'bar')
+        self.assertEqual(self.resolutions.pin(reqs), reqs)
+
+    def test_pinned(self):
+        self.resolutions.store(get_reqs('foo >= 2', 'Bar_Baz'), {'foo': '2.5', 'Bar_Baz': '1.0'})
+        pinned = self.resolutions.pin(get_reqs('foo >= 2', 'bar-baz', 'other'))
+        self.assertEqual([str(req) for req in pinned], ['foo==2.5', 'bar-baz==1.0', 'other'])
+
+    def test_different_specifier_not_pinned(self):
+        self.resolutions.store(get_reqs('foo >= 2'), {'foo': '2.5'})
+        reqs = get_reqs('foo >= 3', 'foo')
+        self.assertEqual(self.resolutions.pin(reqs), reqs)
+
+    def test_extras_and_markers_kept(self):
+        reqs = get_reqs('foo[b,a] >= 2; python_version >= "3"')
+        self.resolutions.store(reqs, {'foo': '2.5'})
+        pinned = self.resolutions.pin(reqs)
+        self.assertEqual(str(pinned[0]), 'foo[a,b]==2.5; python_version >= "3"')
+
+    def test_expired(self):
+        with patch.object(resolutions.time, 'time', return_value=1000):
+            self.resolutions.store(get_reqs('foo >= 2'), {'foo': '2.5'})
+        reqs = get_reqs('foo >= 2')
+        with patch.object(resolutions.time, 'time', return_value=1050):
+            self.assertEqual(str(self.resolutions.pin(reqs)[0]), 'foo==2.5')
+        with patch.object(resolutions.time, 'time', return_value=1101):
+            self.assertEqual(self.resolutions.pin(reqs), reqs)
+
+    def test_disabled(self):
+        self.resolutions.store(get_reqs('foo >= 2'), {'foo': '2.5'})
+        reqs = get_reqs('foo >= 2')
+        self.assertEqual(resolutions.ResolutionsCache(self.filepath, ttl=0).pin(reqs), reqs)
+
+    def test_other_interpreter(self):
+        self.resolutions.store(get_reqs('foo >= 2'), {'foo': '2.5'})
+        reqs = get_reqs('foo >= 2')
+        with patch.object(resolutions, '_get_interpreter', return_value='otherpython9.9'):
+            self.assertEqual(self.resolutions.pin(reqs), reqs)
+
+    def test_exact_versions_not_stored(self):
+        self.resolutions.store(get_reqs('foo == 2.5'), {'foo': '2.5'})
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def test_not_installed_not_stored(self):
+        self.resolutions.store(get_reqs('foo'), {'bar': '2.5'})
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def test_stored_versions_kept(self):
+        self.resolutions.store(get_reqs('foo'), {'foo': '1'})
+        self.resolutions.store(get_reqs('bar'), {'bar': '2'})
+        with open(self.filepath, 'rt', encoding='utf8') as fh:
+            self.assertEqual(len(json.load(fh)), 2)
+
+    def test_broken_file(self):
+        with open(self.filepath, 'wt', encoding='utf8') as fh:
+            fh.write('{"broken')
+        reqs = get_reqs('foo')
+        with self.assertLogs('fades.resolutions', level=logging.WARNING):
+            self.assertEqual(self.resolutions.pin(reqs), reqs)
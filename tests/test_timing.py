@@ -0,0 +1,81 @@
+# Copyright 2015 Facundo Batista, Nicolás Demarchi
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/fades
+
+"""Tests for the timing of the phases."""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest.mock import patch
+
+from fades import timing
+
+
+class TimingTestCase(unittest.TestCase):
+    """Measure and report the spans."""
+
+    def setUp(self):
+        patcher = patch.object(timing, '_spans', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_span(self):
+        with timing.span('foo'):
+            time.sleep(.01)
+        with timing.span('bar'):
+            pass
+        report = timing.get_report()
+        self.assertEqual([item['name'] for item in report['spans']], ['foo', 'bar'])
+        foo, bar = report['spans']
+        self.assertGreaterEqual(foo['duration'], .01)
+        self.assertGreaterEqual(bar['start'], foo['start'] + foo['duration'])
+        self.assertGreaterEqual(report['total'], bar['start'] + bar['duration'])
+
+    def test_span_on_error(self):
+        with self.assertRaises(ValueError):
+            with timing.span('foo'):
+                raise ValueError()
+        self.assertEqual(timing.get_report()['spans'][0]['name'], 'foo')
+
+    def test_report_logged(self):
+        with timing.span('foo'):
+            pass
+        with self.assertLogs('fades.timing', level=logging.DEBUG) as logcheck:
+            timing.report()
+        self.assertIn('foo', logcheck.output[1])
+        self.assertIn('total', logcheck.output[2])
+
+    def test_report_file(self):
+        tempdir = tempfile.mkdtemp(prefix="test-temp-dir")
+        self.addCleanup(shutil.rmtree, tempdir)
+        filepath = os.path.join(tempdir, 'report.json')
+        with timing.span('foo'):
+            pass
+        timing.report(filepath)
+        with open(filepath, 'rt', encoding='utf8') as fh:
+            report = json.load(fh)
+        self.assertEqual(report['spans'][0]['name'], 'foo')
+        self.assertIn('total', report)
+
+    def test_report_file_error(self):
+        with self.assertLogs('fades.timing', level=logging.WARNING) as logcheck:
+            timing.report('/not/there/report.json')
+        self.assertIn("Couldn't write the timing report", logcheck.output[-1])